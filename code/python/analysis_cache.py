@@ -0,0 +1,54 @@
+import hashlib
+import os
+import pandas as pd
+from utils import setup_logging
+
+log = setup_logging()
+
+# Bump when the per-year computations change, so stale cached results are not reused
+CACHE_VERSION = "1"
+
+
+def fingerprint_rows(rows):
+    '''
+    Returns an order-independent fingerprint of a DataFrame's rows (values and dtypes).
+    '''
+    rows = rows.sort_values(list(rows.columns), kind="stable")
+    digest = hashlib.sha256(CACHE_VERSION.encode())
+    digest.update(str(list(rows.dtypes.astype(str).items())).encode())
+    digest.update(pd.util.hash_pandas_object(rows, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def load_year_cache(path):
+    '''
+    Loads cached per-year results, or returns None if there is no cache yet.
+    '''
+    if path is None or not os.path.exists(path):
+        return None
+    cache = pd.read_parquet(path)
+    log.info(f"Loaded {len(cache)} cached per-year results from {path}")
+    return cache
+
+
+def save_year_cache(cache, path):
+    '''
+    Saves per-year results together with the fingerprints of their input rows.
+    '''
+    if path is None:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cache.to_parquet(path, index=False)
+    log.info(f"Saved {len(cache)} per-year results to {path}")
+
+
+def cached_lookup(cache, keys):
+    '''
+    Indexes a loaded cache by its key columns, mapping each key to (fingerprint, row).
+    '''
+    if cache is None:
+        return {}
+    return {
+        tuple(row[k] for k in keys): (row["fingerprint"], row)
+        for row in cache.to_dict("records")
+    }
@@ -0,0 +1,265 @@
+# --- Header -------------------------------------------------------------------
+# Resident analysis service: keeps the BHR results and the daily return index in memory
+#
+# (C) Mel Mzv - See LICENSE file for details
+# ------------------------------------------------------------------------------
+#
+# Usage (from the project root, after the prepare step):
+#   python code/python/pipeline.py serve                       # localhost HTTP (see config)
+#   python code/python/pipeline.py serve --socket /tmp/analysis.sock
+#
+# Queries (GET, JSON responses):
+#   /status                                   loaded files and row counts
+#   /summary?firms=101,102&year_from=2010     Table 1 summary statistics
+#   /regress?year_from=2000&year_to=2010      per-year regressions
+#   /window_bhr?start=-5&end=5&firms=101      BHR around each announcement (calendar-day offsets)
+# `firms` (infocodes), `year_from` and `year_to` are optional filters for every query.
+# Example: curl "http://127.0.0.1:8765/regress?year_from=2005"
+#          curl --unix-socket /tmp/analysis.sock "http://localhost/summary"
+#
+# The data is loaded once and a file is reloaded only when its modification time in
+# data/generated changes. Each reload publishes a new snapshot; requests are served
+# concurrently from the current snapshot, which query handlers only read from.
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+from utils import read_config, setup_logging
+from storage import read_output
+from schema import to_day_number
+from bhr_index import window_bhr
+from sampling import tag_output_paths
+from pipeline import load_script
+
+log = setup_logging()
+
+# Artifact -> (Parquet path key, CSV path key) in do_analysis_cfg.yaml
+SOURCES = {
+    "bhr_event": ("bhr_event_output_parquet", "bhr_event_output_csv"),
+    "bhr_annual": ("bhr_annual_output_parquet", "bhr_annual_output_csv"),
+    "return_index": ("return_index_parquet", None),
+}
+
+
+def main(argv=None):
+    cfg = tag_output_paths(read_config('config/do_analysis_cfg.yaml'))
+    parser = argparse.ArgumentParser(description="Serve analysis queries from data kept in memory.")
+    parser.add_argument("--host", default=cfg.get("service_host", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=cfg.get("service_port", 8765))
+    parser.add_argument("--socket", help="Serve on this Unix socket instead of localhost HTTP")
+    args = parser.parse_args(argv)
+
+    data = AnalysisData(cfg)
+    data.refresh()
+    watcher = threading.Thread(target=data.watch, args=(cfg.get("service_poll_seconds", 5),), daemon=True)
+    watcher.start()
+
+    handler = type("Handler", (QueryHandler,), {"data": data, "analysis": load_script("do_analysis-wscp.py")})
+    if args.socket:
+        server = UnixHTTPServer(args.socket, handler)
+        log.info(f"Analysis service listening on {args.socket}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        log.info(f"Analysis service listening on http://{args.host}:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Shutting down the analysis service.")
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+class AnalysisData:
+    '''
+    The loaded artifacts. `snapshot` is replaced as a whole on reload and never modified,
+    so concurrent requests can share it without copying or locking.
+    '''
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.snapshot = {}
+        self._mtimes = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        '''
+        Reloads the artifacts whose files changed since they were last loaded.
+        '''
+        with self._lock:
+            frames = dict(self.snapshot)
+            for name, (parquet_key, csv_key) in SOURCES.items():
+                path = _existing_path(self.cfg.get(parquet_key), self.cfg.get(csv_key))
+                if path is None:
+                    continue
+                mtime = _mtime(path)
+                if self._mtimes.get(name) == mtime:
+                    continue
+                try:
+                    frames[name] = _load(name, self.cfg[parquet_key], self.cfg.get(csv_key))
+                except Exception as e:  # e.g. the prepare step is rewriting the file
+                    log.warning(f"Could not reload {name} from {path}, keeping the loaded data: {e}")
+                    continue
+                self._mtimes[name] = mtime
+                log.info(f"Loaded {name} from {path}: {len(frames[name])} rows")
+            self.snapshot = frames
+
+    def watch(self, poll_seconds):
+        while True:
+            time.sleep(poll_seconds)
+            self.refresh()
+
+    def status(self):
+        return {name: {"rows": len(df), "modified": time.ctime(self._mtimes[name])}
+                for name, df in self.snapshot.items()}
+
+
+def _existing_path(parquet_path, csv_path):
+    for path in (parquet_path, csv_path):
+        if path and os.path.exists(path):
+            return path
+    return None
+
+
+def _mtime(path):
+    '''
+    Modification time of a file, or the latest one inside a partitioned directory.
+    '''
+    if os.path.isfile(path):
+        return os.path.getmtime(path)
+    times = [os.path.getmtime(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files]
+    return max(times, default=os.path.getmtime(path))
+
+
+def _load(name, parquet_path, csv_path):
+    df = read_output(parquet_path, csv_path)
+    if name == "bhr_event":
+        # Announcement day numbers for the window queries
+        df["rdq"] = pd.to_datetime(df["rdq"])
+        df["rdq_day"] = to_day_number(df["rdq"])
+    return df
+
+
+def _int_list(params, key):
+    values = params.get(key)
+    if not values:
+        return None
+    return [int(v) for value in values for v in value.split(",") if v]
+
+
+def _int_param(params, key, default=None):
+    values = params.get(key)
+    return int(values[0]) if values else default
+
+
+def select(df, params, year):
+    '''
+    Applies the optional `firms`, `year_from` and `year_to` filters; `year` gives each row's year.
+    '''
+    mask = np.ones(len(df), dtype=bool)
+    firms = _int_list(params, "firms")
+    if firms is not None:
+        mask &= df["infocode"].isin(firms).to_numpy()
+    year_from, year_to = _int_param(params, "year_from"), _int_param(params, "year_to")
+    if year_from is not None:
+        mask &= (year >= year_from).to_numpy()
+    if year_to is not None:
+        mask &= (year <= year_to).to_numpy()
+    return df[mask]
+
+
+def _frame(snapshot, name):
+    if name not in snapshot:
+        raise ValueError(f"{name} is not loaded; run the prepare step first")
+    return snapshot[name]
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    '''
+    Answers the queries; `data` (AnalysisData) and `analysis` (the do_analysis script) are
+    set on the subclass created in `main`.
+    '''
+    data = None
+    analysis = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        routes = {"/status": self.status, "/summary": self.summary,
+                  "/regress": self.regress, "/window_bhr": self.window_bhr}
+        if url.path not in routes:
+            return self._send(404, {"error": f"Unknown query {url.path}", "queries": sorted(routes)})
+        try:
+            result = routes[url.path](params, self.data.snapshot)
+        except ValueError as e:
+            return self._send(400, {"error": str(e)})
+        except Exception as e:
+            log.exception(f"Query {self.path} failed")
+            return self._send(500, {"error": str(e)})
+        if isinstance(result, pd.DataFrame):
+            result = json.loads(result.to_json(orient="records", date_format="iso"))
+        self._send(200, result)
+
+    def status(self, params, snapshot):
+        return self.data.status()
+
+    def _selected_inputs(self, params, snapshot):
+        annual, event = _frame(snapshot, "bhr_annual"), _frame(snapshot, "bhr_event")
+        return (select(annual, params, annual["year_stock"]),
+                select(event, params, event["rdq"].dt.year))
+
+    def summary(self, params, snapshot):
+        return self.analysis.compute_summary_statistics(*self._selected_inputs(params, snapshot))
+
+    def regress(self, params, snapshot):
+        return self.analysis.run_regressions(*self._selected_inputs(params, snapshot))
+
+    def window_bhr(self, params, snapshot):
+        start, end = _int_param(params, "start", -1), _int_param(params, "end", 1)
+        if start > end:
+            raise ValueError(f"Window start {start} is after its end {end}")
+        event = _frame(snapshot, "bhr_event")
+        event = select(event, params, event["rdq"].dt.year)
+        bhr = window_bhr(_frame(snapshot, "return_index"), event["infocode"], event["rdq_day"] + start, event["rdq_day"] + end)
+        return pd.DataFrame({"infocode": event["infocode"], "rdq": event["rdq"], "quarter": event["quarter"],
+                             "BHR": bhr["BHR"], "n_days": bhr["n_days"]})
+
+    def _send(self, status, body):
+        payload = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # Unix socket clients have no address, so log without it
+        log.info(f"[service] {format % args}")
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    '''
+    HTTP server on a Unix socket, for clients on the same machine only.
+    '''
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = "localhost", 0
+
+
+if __name__ == "__main__":
+    main()
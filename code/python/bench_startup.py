@@ -0,0 +1,75 @@
+# --- Header -------------------------------------------------------------------
+# Startup benchmark for the pipeline entry points
+#
+# (C) Mel Mzv - See LICENSE file for details
+# ------------------------------------------------------------------------------
+#
+# Measures the wall-clock time of a fresh interpreter that loads each subcommand's
+# script (without running it) and checks it against a startup budget. Also checks
+# that the heavy dependencies stay unloaded until they are needed.
+# Run from the project root: python code/python/bench_startup.py
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Subcommand -> (startup budget in seconds, modules that must not be imported at startup)
+BUDGETS = {
+    "summary": (1.5, ["matplotlib", "statsmodels"]),
+    "regress": (1.5, ["matplotlib", "statsmodels"]),
+    "figure": (1.5, ["matplotlib", "statsmodels"]),
+    "pooled": (1.5, ["matplotlib", "statsmodels", "scipy"]),
+    "prepare": (1.5, ["matplotlib", "statsmodels"]),
+    "serve": (1.5, ["matplotlib", "statsmodels"]),
+    "pull": (0.5, ["wrds", "pandas"]),
+}
+
+CHILD = """
+import sys
+sys.path.insert(0, {script_dir!r})
+import pipeline
+pipeline.load_script(pipeline.COMMANDS[{command!r}][0])
+print(",".join(m for m in {forbidden!r} if m in sys.modules))
+"""
+
+
+def measure(command, forbidden, repeats):
+    '''
+    Returns the median startup time of `command` and the forbidden modules it loaded.
+    '''
+    timings = []
+    loaded = ""
+    for _ in range(repeats):
+        code = CHILD.format(script_dir=SCRIPT_DIR, command=command, forbidden=forbidden)
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        timings.append(time.perf_counter() - start)
+        loaded = result.stdout.strip()
+    return statistics.median(timings), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pipeline startup times.")
+    parser.add_argument("--repeats", type=int, default=5, help="Runs per subcommand (median is reported)")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply all budgets, e.g. on slow machines")
+    args = parser.parse_args()
+
+    failed = False
+    for command, (budget, forbidden) in BUDGETS.items():
+        elapsed, loaded = measure(command, forbidden, args.repeats)
+        budget *= args.scale
+        ok = elapsed <= budget and not loaded
+        failed = failed or not ok
+        note = f" (loaded {loaded} at startup)" if loaded else ""
+        print(f"{'OK  ' if ok else 'FAIL'} {command:<8} {elapsed:6.3f}s / budget {budget:.2f}s{note}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
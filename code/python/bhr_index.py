@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+from ordering import ensure_sorted, firm_day_keys, mark_sorted, segment_starts
+
+# Prefix cumulative-return index over the daily Datastream panel.
+# Rows are sorted by (infocode, marketdate). Within each firm, `prefix_log_ret` holds the
+# sum of log(1 + ret) before the day and `cum_log_ret` the sum up to and including it, so the
+# buy-and-hold return over any window is
+#   BHR = exp(cum_log_ret[last day] - prefix_log_ret[first day]) - 1,
+# i.e. a binary search on the stored `key` column and two lookups, vectorized over all queries.
+# Missing returns contribute nothing, as with `(1 + ret).prod()`. Days with `ret <= -1` (a total
+# loss) are counted in `prefix_losses`/`cum_losses` instead, and any window containing one has a
+# BHR of -1.
+
+INDEX_ORDER = ["infocode", "marketdate"]
+
+
+def build_return_index(ds2dsf):
+    '''
+    Builds the prefix index from the compact daily panel (`infocode`, `marketdate` as day number, `ret`).
+    The running sums are accumulated separately within each firm segment.
+    '''
+    index = ensure_sorted(ds2dsf[["infocode", "marketdate", "ret"]].reset_index(drop=True),
+                          INDEX_ORDER, "return index")
+    ret = index["ret"].to_numpy(dtype=np.float64)
+    total_loss = ret <= -1
+    log_ret = np.zeros(len(ret))
+    usable = ~np.isnan(ret) & ~total_loss
+    log_ret[usable] = np.log1p(ret[usable])
+
+    cum_log_ret = np.empty_like(log_ret)
+    cum_losses = np.empty(len(ret), dtype=np.int32)
+    bounds = np.append(segment_starts(index, ["infocode"]), len(index))
+    for first, end in zip(bounds[:-1], bounds[1:]):
+        np.cumsum(log_ret[first:end], out=cum_log_ret[first:end])
+        np.cumsum(total_loss[first:end], out=cum_losses[first:end])
+
+    index["key"] = firm_day_keys(index["infocode"], index["marketdate"])
+    index["prefix_log_ret"] = cum_log_ret - log_ret
+    index["cum_log_ret"] = cum_log_ret
+    index["prefix_losses"] = cum_losses - total_loss.astype(np.int32)
+    index["cum_losses"] = cum_losses
+    return mark_sorted(index, INDEX_ORDER)
+
+
+def _verified_keys(return_index):
+    '''
+    The search keys of the index, checked to be in order the first time an index is queried.
+    The check is recorded with the address of the key column, so a reordered copy is checked again.
+    '''
+    keys = return_index["key"].to_numpy()
+    checked = (keys.__array_interface__["data"][0], len(keys))
+    if return_index.attrs.get("checked_keys") != checked:
+        if (keys[1:] < keys[:-1]).any():
+            raise ValueError("The return index is not sorted by (infocode, marketdate); build it with build_return_index")
+        return_index.attrs["checked_keys"] = checked
+    return keys
+
+
+def window_bhr(return_index, infocodes, start_days, end_days):
+    '''
+    Computes buy-and-hold returns for a batch of (infocode, start day, end day) queries,
+    both ends inclusive, as int32 day numbers. Returns a DataFrame with `BHR`, the
+    number of trading days `n_days` and the day numbers of the first and last of them
+    (`first_day`, `last_day`); windows without trading days get NaN / <NA>.
+    Only the queries are scanned: two binary searches and the prefix lookups.
+    '''
+    keys = _verified_keys(return_index)
+
+    first = np.searchsorted(keys, firm_day_keys(infocodes, start_days), side="left")
+    last = np.searchsorted(keys, firm_day_keys(infocodes, end_days), side="right") - 1
+    n_days = np.maximum(last - first + 1, 0)
+    valid = n_days > 0
+
+    bhr = np.full(len(first), np.nan)
+    f, l = first[valid], last[valid]
+    log_bhr = return_index["cum_log_ret"].to_numpy()[l] - return_index["prefix_log_ret"].to_numpy()[f]
+    losses = return_index["cum_losses"].to_numpy()[l] - return_index["prefix_losses"].to_numpy()[f]
+    bhr[valid] = np.where(losses > 0, -1.0, np.expm1(log_bhr))
+
+    days = return_index["marketdate"].to_numpy()
+    first_day, last_day = np.zeros(len(first), dtype=np.int32), np.zeros(len(first), dtype=np.int32)
+    first_day[valid], last_day[valid] = days[f], days[l]
+
+    index = infocodes.index if isinstance(infocodes, pd.Series) else None
+    return pd.DataFrame({"BHR": bhr, "n_days": n_days,
+                         "first_day": pd.arrays.IntegerArray(first_day, ~valid),
+                         "last_day": pd.arrays.IntegerArray(last_day, ~valid)}, index=index)
+
+
+def year_bounds(years):
+    '''
+    Returns the first and last day numbers of each calendar year.
+    '''
+    years = np.asarray(years, dtype=np.int64)
+    start = (years - 1970).astype("datetime64[Y]").astype("datetime64[D]").astype(np.int64)
+    end = (years - 1969).astype("datetime64[Y]").astype("datetime64[D]").astype(np.int64) - 1
+    return start.astype(np.int32), end.astype(np.int32)
+
+
+def window_label(window):
+    '''
+    Column label for an event window, e.g. (-1, 1) -> BHR_m1_p1.
+    '''
+    return "BHR_" + "_".join(f"m{-d}" if d < 0 else f"p{d}" for d in window)
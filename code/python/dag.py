@@ -0,0 +1,135 @@
+import time
+from contextlib import ExitStack
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from utils import setup_logging
+
+log = setup_logging()
+
+
+@dataclass
+class Stage:
+    '''
+    A pipeline stage: `func` is called with the named `inputs` as keyword arguments and
+    returns its `outputs` (a single value for one output, a tuple for several, nothing for none).
+    Stages run on the thread pool unless `pool="process"` (the function and its inputs must
+    then be picklable, so use it for CPU-bound stages with small inputs).
+    '''
+    name: str
+    func: callable
+    inputs: list = field(default_factory=list)
+    outputs: list = field(default_factory=list)
+    pool: str = "thread"
+
+
+def run_dag(stages, max_workers=4, initial=None):
+    '''
+    Runs the stages as soon as their inputs are available, with independent stages running
+    concurrently. Returns all produced values by name and logs the critical path.
+    '''
+    values = dict(initial or {})
+    _check_dag(stages, values)
+
+    pending = list(stages)
+    running = {}
+    timings = {}
+    start_all = time.perf_counter()
+
+    with ExitStack() as stack:
+        threads = stack.enter_context(ThreadPoolExecutor(max_workers=max_workers))
+        processes = None
+        if any(s.pool == "process" for s in stages):
+            processes = stack.enter_context(ProcessPoolExecutor(max_workers=max_workers))
+
+        while pending or running:
+            # Submit every stage whose inputs are ready
+            for stage in [s for s in pending if all(i in values for i in s.inputs)]:
+                pending.remove(stage)
+                pool = processes if stage.pool == "process" else threads
+                kwargs = {i: values[i] for i in stage.inputs}
+                future = pool.submit(_timed, stage.func, kwargs)
+                running[future] = stage
+                log.info(f"[dag] Started {stage.name}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    result, started, finished = future.result()
+                except Exception:
+                    log.error(f"[dag] Stage {stage.name} failed; cancelling the remaining stages.")
+                    for other in running:
+                        other.cancel()
+                    raise
+                timings[stage.name] = (started - start_all, finished - start_all)
+                values.update(_unpack(stage, result))
+                log.info(f"[dag] Finished {stage.name} in {finished - started:.2f}s")
+
+    wall = time.perf_counter() - start_all
+    report_critical_path(stages, timings, wall)
+    return values
+
+
+def _timed(func, kwargs):
+    started = time.perf_counter()
+    result = func(**kwargs)
+    return result, started, time.perf_counter()
+
+
+def _unpack(stage, result):
+    if not stage.outputs:
+        return {}
+    if len(stage.outputs) == 1:
+        return {stage.outputs[0]: result}
+    return dict(zip(stage.outputs, result))
+
+
+def _check_dag(stages, values):
+    '''
+    Ensures every input is produced exactly once and the stages form no cycle.
+    '''
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in producers or output in values:
+                raise ValueError(f"{output} is produced by more than one stage")
+            producers[output] = stage.name
+
+    available = set(values)
+    remaining = list(stages)
+    while remaining:
+        ready = [s for s in remaining if all(i in available for i in s.inputs)]
+        if not ready:
+            missing = {i for s in remaining for i in s.inputs if i not in available and i not in producers}
+            if missing:
+                raise ValueError(f"No stage produces {sorted(missing)}")
+            raise ValueError(f"Cycle between stages {[s.name for s in remaining]}")
+        for stage in ready:
+            remaining.remove(stage)
+            available.update(stage.outputs)
+
+
+def report_critical_path(stages, timings, wall):
+    '''
+    Logs the chain of dependent stages with the longest total run time.
+    '''
+    producers = {o: s for s in stages for o in s.outputs}
+    durations = {name: end - start for name, (start, end) in timings.items()}
+    path_length = {}
+    previous = {}
+    for stage in sorted(stages, key=lambda s: timings[s.name][1]):
+        parents = {producers[i].name for i in stage.inputs if i in producers}
+        best = max(parents, key=lambda p: path_length[p], default=None)
+        path_length[stage.name] = durations[stage.name] + (path_length[best] if best else 0.0)
+        previous[stage.name] = best
+
+    last = max(path_length, key=path_length.get)
+    path = []
+    while last:
+        path.append(last)
+        last = previous[last]
+    chain = " -> ".join(f"{name} ({durations[name]:.2f}s)" for name in reversed(path))
+    busy = sum(durations.values())
+    log.info(f"[dag] Critical path: {chain}")
+    log.info(f"[dag] Critical path {path_length[path[0]]:.2f}s, wall time {wall:.2f}s, "
+             f"total stage time {busy:.2f}s")
@@ -1,182 +1,409 @@
 # We start by loading the libraries that we will use in this analysis.
+# matplotlib and statsmodels are heavy to import and only needed by `plot_figure1`
+# and `run_regressions`, so they are imported there.
+import argparse
 import os
 import pickle
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import statsmodels.api as sm
 from utils import read_config, setup_logging
+from storage import read_output
+from dag import Stage, run_dag
+from sampling import sample_fraction, tag_output_paths
+from analysis_cache import cached_lookup, fingerprint_rows, load_year_cache, save_year_cache
 
 # Set up logging
 log = setup_logging()
 
-def main():
-    log.info("Starting analysis ...")
-    cfg = read_config('config/do_analysis_cfg.yaml')
-
-    # Load datasets
+STEPS = ["all", "summary", "regress", "figure", "pooled"]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the Ball (2008) replication analysis.")
+    parser.add_argument("step", nargs="?", default="all", choices=STEPS,
+                        help="Analysis step to run (default: all)")
+    parser.add_argument("--full", action="store_true",
+                        help="Recompute every year and overwrite the cached per-year results")
+    parser.add_argument("--firm-effects", action="store_true",
+                        help="Pooled regression: absorb firm fixed effects in addition to year fixed effects")
+    args = parser.parse_args(argv)
+
+    log.info(f"Starting analysis ({args.step}) ...")
+    cfg = tag_output_paths(read_config('config/do_analysis_cfg.yaml'))
+    if sample_fraction(cfg) < 1:
+        log.info(f"Quick-look mode: analysing the {sample_fraction(cfg):.1%} firm sample; outputs are tagged accordingly.")
+
+    if args.step == "figure":
+        # Figure only: reuse the saved regression results
+        df_regression = pd.read_csv(cfg["regression_results_csv"])
+        plot_figure1(df_regression, cfg["figure1_save_path"], cfg['figure1_pickle_path'],
+                     cfg.get("matplotlib_backend", "Agg"))
+        log.info("Analysis complete.")
+        return
+
+    # Per-year caches for incremental re-analysis (disabled with `incremental: false`);
+    # --full recomputes every year and overwrites the cached entries
+    incremental = cfg.get("incremental", True)
+    summary_cache = cfg.get("summary_cache_parquet") if incremental else None
+    regression_cache = cfg.get("regression_cache_parquet") if incremental else None
+
+    # The steps run as a DAG: the two loads run concurrently, and the summary statistics
+    # do not depend on the regressions, so they overlap with them and the figure.
     log.info("Loading computed BHR Event and BHR Annual datasets...")
-    bhr_event_results = pd.read_csv(cfg["bhr_event_output_csv"])
-    bhr_annual_results = pd.read_csv(cfg["bhr_annual_output_csv"])
-
-    # Compute summary statistics
-    df_summary = compute_summary_statistics(bhr_annual_results, bhr_event_results)
-
-    # Save summary statistics
-    summary_statistics_csv = cfg["summary_statistics_csv"]
-    df_summary.to_csv(summary_statistics_csv, index=False)
-    log.info(f"Summary statistics saved to {summary_statistics_csv}")
-
-    # Run annual regressions
-    df_regression = run_regressions(bhr_annual_results, bhr_event_results)
-
-    # Save regression results (CSV)
-    regression_results_csv = cfg["regression_results_csv"]
-    df_regression.to_csv(regression_results_csv, index=False)
-    log.info(f"Regression results saved to {regression_results_csv}")
-
-    # Generate Figure 1 replication
-    plot_figure1(df_regression, cfg["figure1_save_path"], cfg['figure1_pickle_path'])
+    stages = [
+        Stage("load_bhr_event", lambda: read_output(cfg["bhr_event_output_parquet"], cfg["bhr_event_output_csv"]),
+              outputs=["bhr_event_results"]),
+        Stage("load_bhr_annual", lambda: read_output(cfg["bhr_annual_output_parquet"], cfg["bhr_annual_output_csv"]),
+              outputs=["bhr_annual_results"]),
+    ]
+
+    if args.step in ("all", "summary"):
+        stages.append(Stage("summary_statistics", lambda bhr_annual_results, bhr_event_results: save_csv(
+                                compute_summary_statistics(bhr_annual_results, bhr_event_results, summary_cache, args.full),
+                                cfg["summary_statistics_csv"], "Summary statistics"),
+                            inputs=["bhr_annual_results", "bhr_event_results"]))
+
+    if args.step in ("all", "regress"):
+        stages.append(Stage("regressions", lambda bhr_annual_results, bhr_event_results: save_csv(
+                                run_regressions(bhr_annual_results, bhr_event_results, regression_cache, args.full),
+                                cfg["regression_results_csv"], "Regression results"),
+                            inputs=["bhr_annual_results", "bhr_event_results"], outputs=["df_regression"]))
+
+    if args.step == "pooled":
+        firm_effects = args.firm_effects or cfg.get("pooled_firm_effects", False)
+        stages.append(Stage("pooled_regression", lambda bhr_annual_results, bhr_event_results: save_csv(
+                                run_pooled_regression(bhr_annual_results, bhr_event_results, firm_effects),
+                                cfg["pooled_regression_csv"], "Pooled regression results"),
+                            inputs=["bhr_annual_results", "bhr_event_results"]))
+
+    if args.step == "all":
+        # Generate Figure 1 replication
+        stages.append(Stage("figure1", lambda df_regression: plot_figure1(
+                                df_regression, cfg["figure1_save_path"], cfg['figure1_pickle_path'],
+                                cfg.get("matplotlib_backend", "Agg")),
+                            inputs=["df_regression"]))
+
+    run_dag(stages, max_workers=cfg.get("pipeline_workers", 4))
 
-    
     log.info("Analysis complete.")
 
-def compute_summary_statistics(bhr_annual_results, bhr_event_results):
+def save_csv(df, path, label):
+    """
+    Saves a results table to CSV and passes it on.
+    """
+    df.to_csv(path, index=False)
+    log.info(f"{label} saved to {path}")
+    return df
+
+def compute_summary_statistics(bhr_annual_results, bhr_event_results, cache_path=None, refresh=False):
     """
     Computes summary statistics (Mean, Median, Skewness, % Obs = 0, % Obs > 0) 
     for annual returns and earnings-announcement window returns like in Table 1 by Ball(2008)
     to compare preliminary results.
+    Mean, Skewness and the % columns are combined from per-year accumulators, which are
+    cached with a fingerprint of each year's rows so that only changed years are recomputed
+    (`refresh` recomputes all of them and overwrites the cache).
+    Mean and Skewness skip missing returns, as `np.mean` and `Series.skew` on the columns did,
+    while the % columns count them in the denominator. The median is not decomposable by year
+    and is taken over the full column (NaN if any return is missing, as with `np.median`).
     """
     log.info("Computing summary statistics for comparison with Table 1...")
 
-    # **Annual Returns Summary**
-    annual_stats = {
-        "Category": "Calendar-Year Returns",
-        "No. Obs.": len(bhr_annual_results),
-        "Mean": np.mean(bhr_annual_results["BHR_Annual"]),
-        "Median": np.median(bhr_annual_results["BHR_Annual"]),
-        "Skewness": pd.Series(bhr_annual_results["BHR_Annual"]).skew(),
-        "% Obs. = 0": np.mean(bhr_annual_results["BHR_Annual"] == 0) * 100,
-        "% Obs. > 0": np.mean(bhr_annual_results["BHR_Annual"] > 0) * 100,
-    }
-
-    # **Earnings-Announcement Window Summary (for each quarter)**
-    quarterly_stats = []
+    # Category -> returns with the calendar year each return belongs to
+    groups = {"Calendar-Year Returns": (
+        bhr_annual_results[["infocode", "year_stock", "BHR_Annual"]].rename(columns={"BHR_Annual": "value"}),
+        bhr_annual_results["year_stock"]
+    )}
+    event_years = pd.to_datetime(bhr_event_results["rdq"]).dt.year
     for q in ["Q1", "Q2", "Q3", "Q4"]:
-        df_q = bhr_event_results[bhr_event_results["quarter"] == q]
-
-        q_stats = {
-            "Category": f"Earnings-Announcement Window Returns in {q}",
-            "No. Obs.": len(df_q),
-            "Mean": np.mean(df_q["BHR_3day"]),
-            "Median": np.median(df_q["BHR_3day"]),
-            "Skewness": pd.Series(df_q["BHR_3day"]).skew(),
-            "% Obs. = 0": np.mean(df_q["BHR_3day"] == 0) * 100,
-            "% Obs. > 0": np.mean(df_q["BHR_3day"] > 0) * 100,
-        }
+        mask = bhr_event_results["quarter"] == q
+        groups[f"Earnings-Announcement Window Returns in {q}"] = (
+            bhr_event_results.loc[mask, ["infocode", "rdq", "BHR_3day"]].rename(columns={"BHR_3day": "value"}),
+            event_years[mask]
+        )
 
-        quarterly_stats.append(q_stats)
+    # Reuse cached accumulators for (category, year) groups whose rows are unchanged
+    cached = {} if refresh else cached_lookup(load_year_cache(cache_path), ["Category", "Year"])
+    accumulators = []
+    recomputed = 0
+    for category, (rows, years) in groups.items():
+        for year, year_rows in rows.groupby(years.to_numpy()):
+            fingerprint = fingerprint_rows(year_rows)
+            hit = cached.get((category, year))
+            if hit is not None and hit[0] == fingerprint:
+                accumulators.append(hit[1])
+                continue
+            values = year_rows["value"].to_numpy(dtype=np.float64)
+            valid = values[~np.isnan(values)]
+            accumulators.append({
+                "Category": category, "Year": year, "fingerprint": fingerprint,
+                "n_obs": len(values), "n_valid": len(valid),
+                "sum": valid.sum(), "sum_sq": (valid ** 2).sum(), "sum_cube": (valid ** 3).sum(),
+                "n_zero": int((values == 0).sum()), "n_pos": int((values > 0).sum()),
+            })
+            recomputed += 1
+
+    accumulators = pd.DataFrame(accumulators, columns=[
+        "Category", "Year", "fingerprint", "n_obs", "n_valid", "sum", "sum_sq", "sum_cube", "n_zero", "n_pos"
+    ])
+    log.info(f"Summary accumulators: {recomputed} of {len(accumulators)} category-years recomputed.")
+    save_year_cache(accumulators, cache_path)
+
+    # Combine the per-year accumulators into Table 1
+    totals = accumulators.groupby("Category", sort=False)[
+        ["n_obs", "n_valid", "sum", "sum_sq", "sum_cube", "n_zero", "n_pos"]
+    ].sum()
+    summary_rows = []
+    for category, (rows, _) in groups.items():
+        t = totals.loc[category] if category in totals.index else pd.Series(0.0, index=totals.columns)
+        summary_rows.append({
+            "Category": category,
+            "No. Obs.": len(rows),
+            "Mean": t["sum"] / t["n_valid"] if t["n_valid"] > 0 else np.nan,
+            "Median": np.median(rows["value"]),
+            "Skewness": _skewness_from_sums(t["n_valid"], t["sum"], t["sum_sq"], t["sum_cube"]),
+            "% Obs. = 0": t["n_zero"] / len(rows) * 100 if len(rows) else np.nan,
+            "% Obs. > 0": t["n_pos"] / len(rows) * 100 if len(rows) else np.nan,
+        })
 
     # Convert to DataFrame
-    df_summary = pd.DataFrame([annual_stats] + quarterly_stats)
+    df_summary = pd.DataFrame(summary_rows)
 
     log.info("Computed summary statistics:")
     log.info(df_summary.to_string())
 
     return df_summary
 
-def run_regressions(bhr_annual, bhr_event):
+def _skewness_from_sums(n, s1, s2, s3):
+    """
+    Sample skewness (same adjustment as pandas `Series.skew`) from power sums.
+    """
+    if n < 3:
+        return np.nan
+    m2 = s2 - s1 ** 2 / n
+    m3 = s3 - 3 * s1 * s2 / n + 2 * s1 ** 3 / n ** 2
+    if m2 <= 0:
+        return 0.0
+    return (n * (n - 1) ** 0.5 / (n - 2)) * (m3 / m2 ** 1.5)
+
+REGRESSION_COLUMNS = ["Year", "Intercept", "Q1", "Q2", "Q3", "Q4", "Adj_R²", "Abnormal R²", "No. Obs."]
+
+def run_regressions(bhr_annual, bhr_event, cache_path=None, refresh=False):
     """
     Runs annual cross-sectional regressions of calendar-year returns on 
     the four earnings-announcement window returns in the calendar year.
     Computes Adjusted R² and Abnormal R², following Ball (2008).
+    Per-year results are cached with a fingerprint of the year's input rows, so a
+    rerun only fits the years whose inputs changed (`refresh` refits all of them and
+    overwrites the cache).
     """
-
     log.info("Running annual regressions with Abnormal R² benchmarking...")
 
     # Ensure `year_stock` column exists in BHR Event dataset
     if "year_stock" not in bhr_event.columns:
-        bhr_event["year_stock"] = pd.to_datetime(bhr_event["rdq"]).dt.year
+        bhr_event = bhr_event.assign(year_stock=pd.to_datetime(bhr_event["rdq"]).dt.year)
 
     # Merge annual and event datasets
     merged_data = bhr_annual.merge(bhr_event, on=["infocode", "year_stock"], how="inner")
 
-    # Run regressions for each year
-    regression_results = []
-    for year in sorted(merged_data["year_stock"].unique()):
-        yearly_data = merged_data[merged_data["year_stock"] == year]
-
-        # Pivot data to have Q1, Q2, Q3, Q4 as separate columns
-        yearly_pivot = yearly_data.pivot_table(
-            index=["infocode", "year_stock"], 
-            columns="quarter", 
-            values="BHR_3day"
-        ).reset_index()
-
-        # Rename columns for clarity
-        yearly_pivot = yearly_pivot.rename(
-            columns={"Q1": "BHR_Q1", "Q2": "BHR_Q2", "Q3": "BHR_Q3", "Q4": "BHR_Q4"}
-        )
-
-        # Merge back with annual returns
-        final_data = yearly_pivot.merge(bhr_annual, on=["infocode", "year_stock"], how="inner")
-
-        # Define Dependent and Independent Variables
-        independent_vars = ["BHR_Q1", "BHR_Q2", "BHR_Q3", "BHR_Q4"]
-        X = final_data[independent_vars]
-        y = final_data["BHR_Annual"]
-
-        # **Fix Missing Values in Independent Variables**
-        X = X.fillna(0)  # Replace NaNs with 0
-        X = sm.add_constant(X)  # Add intercept
-
-        # **Check for NaNs or Infs in y or X**
-        if X.isna().any().any() or y.isna().any():
-            log.warning(f"Skipping year {year} due to NaNs in data.")
-            continue
-
-        if np.isinf(X).any().any() or np.isinf(y).any():
-            log.warning(f"Skipping year {year} due to Inf values in data.")
+    # Run regressions for each year, reusing cached results for unchanged years
+    cached = {} if refresh else cached_lookup(load_year_cache(cache_path), ["Year"])
+    year_results = []
+    recomputed = 0
+    for year, yearly_data in merged_data.groupby("year_stock", sort=True):
+        fingerprint = fingerprint_rows(yearly_data)
+        hit = cached.get((year,))
+        if hit is not None and hit[0] == fingerprint:
+            year_results.append(hit[1])
             continue
 
-        # **Ensure we have enough observations for valid regression**
-        if X.shape[0] <= X.shape[1]:  
-            log.warning(f"Skipping year {year} due to insufficient observations (n={X.shape[0]}, k={X.shape[1] - 1}).")
-            continue
+        result = _regress_year(year, yearly_data)
+        recomputed += 1
+        # Skipped years are cached too, so they are not refitted on every run
+        year_results.append({**(result or {"Year": year}), "skipped": result is None, "fingerprint": fingerprint})
 
-        # Fit Regression Model
-        model = sm.OLS(y, X).fit()
-
-        # Compute Adjusted R² & Abnormal R²
-        adj_r2 = model.rsquared_adj if model.nobs > model.df_model + 1 else np.nan
-        abnormal_r2 = adj_r2 - 0.048 if not np.isnan(adj_r2) else np.nan
-
-        # Store results
-        regression_results.append({
-            "Year": year,
-            "Intercept": model.params["const"],
-            "Q1": model.params.get("BHR_Q1", np.nan),
-            "Q2": model.params.get("BHR_Q2", np.nan),
-            "Q3": model.params.get("BHR_Q3", np.nan),
-            "Q4": model.params.get("BHR_Q4", np.nan),
-            "Adj_R²": adj_r2,
-            "Abnormal R²": abnormal_r2,  # New column
-            "No. Obs.": len(final_data)
-        })
+    cache = pd.DataFrame(year_results, columns=REGRESSION_COLUMNS + ["skipped", "fingerprint"])
+    log.info(f"Annual regressions: {recomputed} of {len(cache)} years recomputed.")
+    save_year_cache(cache, cache_path)
 
-    results_df = pd.DataFrame(regression_results)
+    results_df = cache.loc[~cache["skipped"].astype(bool), REGRESSION_COLUMNS].reset_index(drop=True)
+    results_df = results_df.astype({"Year": int, "No. Obs.": int})
 
     # **Fill NaN Adj_R² with a marker (-999) if needed**
     results_df["Adj_R²"] = results_df["Adj_R²"].fillna(-999)
     results_df["Abnormal R²"] = results_df["Abnormal R²"].fillna(-999)
 
     # Display the output
-    print("\nRegression Results with Abnormal R²:\n", results_df.round(3).to_string(index=False))    
+    log.info("Regression Results with Abnormal R²:")
+    log.info(results_df.round(3).to_string(index=False))
+
+    return results_df
+
+def _regress_year(year, yearly_data):
+    """
+    Fits the cross-sectional regression for one year. Returns None if the year is skipped.
+    """
+    import statsmodels.api as sm
+
+    # Pivot data to have Q1, Q2, Q3, Q4 as separate columns
+    yearly_pivot = yearly_data.pivot_table(
+        index=["infocode", "year_stock"], 
+        columns="quarter", 
+        values="BHR_3day",
+        observed=False
+    ).reset_index()
+
+    # Rename columns for clarity
+    yearly_pivot = yearly_pivot.rename(
+        columns={"Q1": "BHR_Q1", "Q2": "BHR_Q2", "Q3": "BHR_Q3", "Q4": "BHR_Q4"}
+    )
+
+    # Merge back with annual returns of the same year
+    bhr_annual = yearly_data[["infocode", "year_stock", "BHR_Annual"]].drop_duplicates()
+    final_data = yearly_pivot.merge(bhr_annual, on=["infocode", "year_stock"], how="inner")
+
+    # Define Dependent and Independent Variables
+    independent_vars = ["BHR_Q1", "BHR_Q2", "BHR_Q3", "BHR_Q4"]
+    X = final_data.reindex(columns=independent_vars)  # a quarter can be absent in small samples
+    y = final_data["BHR_Annual"]
+
+    # **Fix Missing Values in Independent Variables**
+    X = X.fillna(0)  # Replace NaNs with 0
+    X = sm.add_constant(X)  # Add intercept
+
+    # **Check for NaNs or Infs in y or X**
+    if X.isna().any().any() or y.isna().any():
+        log.warning(f"Skipping year {year} due to NaNs in data.")
+        return None
+
+    if np.isinf(X).any().any() or np.isinf(y).any():
+        log.warning(f"Skipping year {year} due to Inf values in data.")
+        return None
+
+    # **Ensure we have enough observations for valid regression**
+    if X.shape[0] <= X.shape[1]:  
+        log.warning(f"Skipping year {year} due to insufficient observations (n={X.shape[0]}, k={X.shape[1] - 1}).")
+        return None
+
+    # Fit Regression Model
+    model = sm.OLS(y, X).fit()
+
+    # Compute Adjusted R² & Abnormal R²
+    adj_r2 = model.rsquared_adj if model.nobs > model.df_model + 1 else np.nan
+    abnormal_r2 = adj_r2 - 0.048 if not np.isnan(adj_r2) else np.nan
+
+    return {
+        "Year": year,
+        "Intercept": model.params["const"],
+        "Q1": model.params.get("BHR_Q1", np.nan),
+        "Q2": model.params.get("BHR_Q2", np.nan),
+        "Q3": model.params.get("BHR_Q3", np.nan),
+        "Q4": model.params.get("BHR_Q4", np.nan),
+        "Adj_R²": adj_r2,
+        "Abnormal R²": abnormal_r2,  # New column
+        "No. Obs.": len(final_data)
+    }
+
+POOLED_VARIABLES = ["BHR_Q1", "BHR_Q2", "BHR_Q3", "BHR_Q4"]
+POOLED_COLUMNS = ["Variable", "Coefficient", "Std. Error", "t-stat", "p-value",
+                  "Fixed Effects", "Within R²", "No. Obs.", "No. Firms", "No. Years"]
+
+def run_pooled_regression(bhr_annual, bhr_event, firm_effects=False):
+    """
+    Pooled regression of calendar-year returns on the four earnings-announcement window
+    returns across all years, with year (and optionally firm) fixed effects and standard
+    errors clustered by firm. The fixed effects are absorbed by within-demeaning and the
+    covariance is built from per-firm sums, so time and memory grow linearly with the
+    number of firm-years instead of with a dummy variable per year or firm.
+    p-values use a t distribution with (number of firms - 1) degrees of freedom.
+    """
+    log.info(f"Running pooled regression with {'year and firm' if firm_effects else 'year'} fixed effects...")
+    from scipy import stats
+
+    # Same input as the annual regressions: one row per firm-year with BHR_Q1-BHR_Q4 and BHR_Annual
+    if "year_stock" not in bhr_event.columns:
+        bhr_event = bhr_event.assign(year_stock=pd.to_datetime(bhr_event["rdq"]).dt.year)
+    merged_data = bhr_annual.merge(bhr_event, on=["infocode", "year_stock"], how="inner")
+    panel = merged_data.pivot_table(
+        index=["infocode", "year_stock"], columns="quarter", values="BHR_3day", observed=False
+    ).rename(columns={"Q1": "BHR_Q1", "Q2": "BHR_Q2", "Q3": "BHR_Q3", "Q4": "BHR_Q4"})
+    panel = panel.reindex(columns=POOLED_VARIABLES).fillna(0).reset_index()  # Missing quarters as in the annual regressions
+    annual = merged_data[["infocode", "year_stock", "BHR_Annual"]].drop_duplicates()
+    panel = panel.merge(annual, on=["infocode", "year_stock"], how="inner")
+
+    values = panel[["BHR_Annual"] + POOLED_VARIABLES].to_numpy(dtype=np.float64)
+    finite = np.isfinite(values).all(axis=1)
+    if not finite.all():
+        log.warning(f"Dropping {(~finite).sum()} firm-years with NaN or Inf values from the pooled regression.")
+    panel, values = panel[finite], values[finite]
+
+    firms = pd.factorize(panel["infocode"])[0]
+    years = pd.factorize(panel["year_stock"])[0]
+    n_obs, n_firms, n_years = len(panel), firms.max(initial=-1) + 1, years.max(initial=-1) + 1
+
+    # Absorbed fixed effects not nested in the firm clusters count towards the degrees of freedom
+    k = len(POOLED_VARIABLES)
+    n_params = k + n_years - (1 if firm_effects else 0)
+    if n_firms < 2 or n_obs <= n_params:
+        log.warning(f"Skipping pooled regression due to insufficient data (n={n_obs}, firms={n_firms}).")
+        return pd.DataFrame(columns=POOLED_COLUMNS)
+
+    demeaned = _within_transform(values, [years, firms] if firm_effects else [years])
+    y, X = demeaned[:, 0], demeaned[:, 1:]
+
+    # Normal equations (k x k) and firm-clustered sandwich covariance
+    XtX = X.T @ X
+    beta = np.linalg.solve(XtX, X.T @ y)
+    resid = y - X @ beta
+    scores = np.column_stack([np.bincount(firms, weights=X[:, j] * resid, minlength=n_firms) for j in range(k)])
+    bread = np.linalg.inv(XtX)
+    correction = n_firms / (n_firms - 1) * (n_obs - 1) / (n_obs - n_params)
+    cov = correction * bread @ (scores.T @ scores) @ bread
+
+    std_err = np.sqrt(np.diag(cov))
+    t_stat = beta / std_err
+    p_value = 2 * stats.t.sf(np.abs(t_stat), n_firms - 1)
+    within_r2 = 1 - (resid @ resid) / (y @ y) if y @ y > 0 else np.nan
+
+    results_df = pd.DataFrame({
+        "Variable": ["Q1", "Q2", "Q3", "Q4"],
+        "Coefficient": beta, "Std. Error": std_err, "t-stat": t_stat, "p-value": p_value,
+        "Fixed Effects": "Year, Firm" if firm_effects else "Year",
+        "Within R²": within_r2, "No. Obs.": n_obs, "No. Firms": n_firms, "No. Years": n_years,
+    })[POOLED_COLUMNS]
+
+    log.info("Pooled Regression Results (firm-clustered standard errors):")
+    log.info(results_df.round(3).to_string(index=False))
 
     return results_df
 
-def plot_figure1(results_df, save_path, pickle_path):
-    """Replicates Figure 1 from Ball (2008) and saves it as PNG and Pickle."""
+def _within_transform(values, groups, tol=1e-10, max_iter=1000):
+    """
+    Subtracts group means of each column for every grouping (integer codes). With two groupings,
+    alternates between them until the means vanish (alternating projections).
+    """
+    values = values.copy()
+    counts = [np.bincount(g) for g in groups]
+    for _ in range(max_iter):
+        largest_mean = 0.0
+        for g, n in zip(groups, counts):
+            means = np.column_stack([
+                np.bincount(g, weights=values[:, j], minlength=len(n)) for j in range(values.shape[1])
+            ]) / n[:, None]
+            values -= means[g]
+            largest_mean = max(largest_mean, np.abs(means).max(initial=0.0))
+        if len(groups) == 1 or largest_mean < tol:
+            return values
+    log.warning(f"Within transformation did not converge after {max_iter} iterations.")
+    return values
+
+def plot_figure1(results_df, save_path, pickle_path, backend="Agg"):
+    """
+    Replicates Figure 1 from Ball (2008) and saves it as PNG and Pickle.
+    Uses a non-interactive backend unless `MPLBACKEND` says otherwise.
+    """
+    import matplotlib
+    matplotlib.use(os.environ.get("MPLBACKEND", backend))
+    import matplotlib.pyplot as plt
 
     log.info("Generating Figure 1 replication...")
 
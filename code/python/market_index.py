@@ -0,0 +1,122 @@
+import os
+import numpy as np
+import pandas as pd
+from utils import setup_logging
+from bhr_index import build_return_index, window_bhr
+from ordering import ensure_sorted, segment_starts
+
+log = setup_logging()
+
+# Daily market return columns and the suffix of the abnormal returns derived from them
+MARKET_COLUMNS = {"mkt_ew": "EW", "mkt_vw": "VW"}
+
+
+def build_market_index(ds2dsf, weight_col=None):
+    '''
+    Builds daily equal-weighted (and, with `weight_col`, value-weighted) market returns
+    per region in a single grouped pass over the compact daily panel.
+    Value weights are each firm's market value on its previous trading day.
+    '''
+    ds2dsf = ensure_sorted(ds2dsf, ["infocode", "marketdate"], "Datastream panel")
+    panel = ds2dsf[["infocode", "region", "marketdate", "ret"]]
+    aggregations = {"mkt_ew": ("ret", "mean"), "n_firms": ("ret", "count")}
+
+    if weight_col:
+        # Previous-day market value: shift by one row, restarting at each firm's first day
+        values = ds2dsf[weight_col].to_numpy(dtype=np.float64)
+        lagged = np.empty_like(values)
+        lagged[1:] = values[:-1]
+        lagged[segment_starts(ds2dsf, ["infocode"])] = np.nan
+        weights = pd.Series(lagged, index=ds2dsf.index).where(ds2dsf["ret"].notna())
+        panel = panel.assign(_w=weights, _wr=weights * ds2dsf["ret"])
+        aggregations.update({"_w": ("_w", "sum"), "_wr": ("_wr", "sum")})
+
+    market = panel.groupby(["region", "marketdate"], observed=True, sort=True).agg(**aggregations).reset_index()
+
+    if weight_col:
+        market["mkt_vw"] = market["_wr"] / market["_w"].where(market["_w"] > 0)
+        market = market.drop(columns=["_w", "_wr"])
+
+    market["region"] = market["region"].astype(str)
+    log.info(f"Built daily market index for {market['region'].nunique()} region(s), {len(market)} region-days.")
+    return market
+
+
+def load_or_build_market_index(ds2dsf, cfg, source_path):
+    '''
+    Returns the daily market index, reusing the cached file if it is newer than the pulled
+    Datastream data and was built with the same weighting; otherwise builds and caches it.
+    '''
+    cache_path = cfg["market_index_parquet"]
+    weight_col = cfg.get("market_value_column")
+
+    if os.path.exists(cache_path) and os.path.exists(source_path) \
+            and os.path.getmtime(cache_path) >= os.path.getmtime(source_path):
+        market = pd.read_parquet(cache_path)
+        if ("mkt_vw" in market.columns) == bool(weight_col):
+            log.info(f"Loaded cached market index from {cache_path}")
+            return market
+
+    market = build_market_index(ds2dsf, weight_col)
+    market.to_parquet(cache_path, index=False)
+    log.info(f"Market index saved to {cache_path}")
+    return market
+
+
+def firm_regions(ds2dsf):
+    '''
+    Maps each `infocode` to the region it is traded in.
+    '''
+    regions = ds2dsf[["infocode", "region"]].drop_duplicates("infocode")
+    return regions.assign(region=regions["region"].astype(str)).reset_index(drop=True)
+
+
+def market_columns(market):
+    '''
+    Returns the market return columns present in the index.
+    '''
+    return [col for col in MARKET_COLUMNS if col in market.columns]
+
+
+def add_market_returns(rows, market, regions, date_col):
+    '''
+    Joins the daily market returns of each row's region and date (a day-number column) onto `rows`.
+    '''
+    rows = rows.merge(regions, on="infocode", how="left")
+    daily = market[["region", "marketdate"] + market_columns(market)].rename(columns={"marketdate": date_col})
+    return rows.merge(daily, on=["region", date_col], how="left")
+
+
+def market_window_bhr(market, regions, infocodes, start_days, end_days):
+    '''
+    Buy-and-hold market returns of each firm's region over inclusive day-number windows,
+    e.g. from the firm's first to its last trading day of a year. Each market column is
+    turned into a prefix return index over (region, marketdate), so a window is two lookups.
+    Windows with a missing bound or region get NaN.
+    '''
+    region_codes = pd.Categorical(market["region"])
+    firm_region = pd.Series(np.asarray(infocodes)).map(regions.set_index("infocode")["region"])
+    firm_codes = pd.Categorical(firm_region, categories=region_codes.categories).codes
+    start_days, end_days = pd.array(start_days, dtype="Int32"), pd.array(end_days, dtype="Int32")
+    valid = ~np.asarray(start_days.isna() | end_days.isna()) & (firm_codes >= 0)
+    starts = start_days[valid].to_numpy(dtype=np.int32)
+    ends = end_days[valid].to_numpy(dtype=np.int32)
+
+    bhr = pd.DataFrame(np.nan, index=range(len(firm_codes)), columns=market_columns(market))
+    for col in bhr.columns:
+        index = build_return_index(pd.DataFrame({
+            "infocode": region_codes.codes.astype(np.int32), "marketdate": market["marketdate"], "ret": market[col],
+        }))
+        bhr.loc[valid, col] = window_bhr(index, firm_codes[valid], starts, ends)["BHR"].to_numpy()
+    return bhr
+
+
+def add_abnormal_returns(df, market_bhr, raw_col, prefix):
+    '''
+    Adds market-adjusted returns (raw BHR minus market BHR over the same window), e.g.
+    BHR_3day -> ABHR_3day_EW and ABHR_3day_VW.
+    '''
+    for col, suffix in MARKET_COLUMNS.items():
+        if col in market_bhr.columns:
+            df[f"{prefix}_{suffix}"] = df[raw_col] - market_bhr[col].to_numpy()
+    return df
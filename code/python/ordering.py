@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+from utils import setup_logging
+
+log = setup_logging()
+
+# Sort-once ordering invariant.
+# The daily panel is put in (infocode, marketdate) order once at ingest and the announcement
+# panel in (infocode, rdq, event_window) order when it is expanded, and downstream steps work on
+# contiguous runs of rows (segments) instead of hash groupbys or re-sorts. Each step checks the
+# order it relies on in one linear pass and only sorts if the frame is actually out of order.
+# `df.attrs["sorted_by"]` records the order for the Parquet metadata of written files; it is not
+# trusted on its own, because pandas copies attrs through sort_values, concat and sample.
+
+ORDER_ATTR = "sorted_by"
+_DAY_OFFSET = np.int64(2 ** 31)  # Shifts int32 day numbers to non-negative values for the composite keys
+
+
+def mark_sorted(df, keys):
+    '''
+    Records that `df` is sorted by `keys` and returns it.
+    '''
+    df.attrs[ORDER_ATTR] = list(keys)
+    return df
+
+
+def sorted_by(df):
+    '''
+    Returns the keys `df` is recorded to be sorted by (empty if unknown).
+    '''
+    return list(df.attrs.get(ORDER_ATTR) or [])
+
+
+def _key_values(col):
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return col.cat.codes.to_numpy()
+    return col.to_numpy()
+
+
+def is_sorted(df, keys):
+    '''
+    Checks in one linear pass whether `df` is sorted lexicographically by `keys`.
+    '''
+    if len(df) < 2:
+        return True
+    out_of_order = np.zeros(len(df) - 1, dtype=bool)
+    tied = np.ones(len(df) - 1, dtype=bool)
+    for key in keys:
+        values = _key_values(df[key])
+        prev, nxt = values[:-1], values[1:]
+        out_of_order |= tied & (nxt < prev)
+        tied &= nxt == prev
+    return not out_of_order.any()
+
+
+def ensure_sorted(df, keys, label="frame"):
+    '''
+    Returns `df` sorted by `keys`: as is if it is verified to be in that order,
+    otherwise sorted (stable) as a fallback.
+    '''
+    keys = list(keys)
+    if is_sorted(df, keys):
+        return mark_sorted(df, keys)
+    log.info(f"Ordering invariant broken for {label}; sorting by {keys}")
+    return mark_sorted(df.sort_values(keys, kind="stable").reset_index(drop=True), keys)
+
+
+def segment_starts(df, keys):
+    '''
+    Positions of the first row of each run of equal `keys` in a frame sorted by them.
+    '''
+    if len(df) == 0:
+        return np.zeros(0, dtype=np.int64)
+    changed = np.zeros(len(df) - 1, dtype=bool)
+    for key in keys:
+        values = _key_values(df[key])
+        changed |= values[1:] != values[:-1]
+    return np.concatenate(([0], np.flatnonzero(changed) + 1))
+
+
+def segment_reduce(ufunc, values, starts):
+    '''
+    Reduces `values` over each segment with a NumPy ufunc (e.g. np.add) in one pass.
+    '''
+    if len(starts) == 0:
+        return np.zeros((0,) + values.shape[1:], dtype=values.dtype)
+    return ufunc.reduceat(values, starts, axis=0)
+
+
+def firm_day_keys(ids, days):
+    '''
+    Single int64 keys ordered like (firm, day) pairs, for binary searches on the sorted panel.
+    '''
+    return (np.asarray(ids, dtype=np.int64) << 32) + (np.asarray(days, dtype=np.int64) + _DAY_OFFSET)
+
+
+def segment_ids(starts, n_rows):
+    '''
+    Maps every row to the number of the segment it belongs to.
+    '''
+    return np.repeat(np.arange(len(starts)), np.diff(np.append(starts, n_rows)))
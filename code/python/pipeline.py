@@ -0,0 +1,66 @@
+# --- Header -------------------------------------------------------------------
+# Subcommand entry point for the pipeline scripts
+#
+# (C) Mel Mzv - See LICENSE file for details
+# ------------------------------------------------------------------------------
+#
+# Usage (from the project root):
+#   python code/python/pipeline.py pull      # Pull Worldscope/Datastream data from WRDS
+#   python code/python/pipeline.py prepare   # Prepare the pulled data
+#   python code/python/pipeline.py summary   # Summary statistics only
+#   python code/python/pipeline.py regress   # Annual regressions only
+#   python code/python/pipeline.py figure    # Figure 1 from saved regression results
+#   python code/python/pipeline.py pooled    # Pooled regression with year (--firm-effects: and firm) fixed effects
+#   python code/python/pipeline.py serve     # Resident analysis service (see analysis_service.py)
+#
+# Further arguments are passed on to the script, e.g. `regress --full` or `serve --socket PATH`.
+#
+# Only the standard library is imported here; each subcommand loads its script
+# (and that script's heavy dependencies) on demand.
+
+import argparse
+import importlib.util
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Subcommand -> (script, arguments passed to the script's main)
+COMMANDS = {
+    "pull": ("pull_wrds_data-wscp.py", None),
+    "prepare": ("prepare_data-wscp.py", None),
+    "summary": ("do_analysis-wscp.py", ["summary"]),
+    "regress": ("do_analysis-wscp.py", ["regress"]),
+    "figure": ("do_analysis-wscp.py", ["figure"]),
+    "pooled": ("do_analysis-wscp.py", ["pooled"]),
+    "serve": ("analysis_service.py", []),
+}
+
+
+def load_script(script):
+    '''
+    Imports a pipeline script by file name (the script names are not valid module names).
+    '''
+    name = script.replace("-", "_").removesuffix(".py")
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SCRIPT_DIR, script))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a step of the Worldscope/Datastream pipeline.")
+    parser.add_argument("command", choices=COMMANDS, help="Pipeline step to run")
+    args, extra = parser.parse_known_args(argv)
+
+    script, script_args = COMMANDS[args.command]
+    if script_args is None and extra:
+        parser.error(f"{args.command} takes no further arguments: {' '.join(extra)}")
+    module = load_script(script)
+    if script_args is None:
+        module.main()
+    else:
+        module.main(script_args + extra)
+
+
+if __name__ == "__main__":
+    main()
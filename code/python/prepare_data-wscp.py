@@ -4,56 +4,168 @@
 # (C) Mel Mzv - See LICENSE file for details
 # ------------------------------------------------------------------------------
 
+import os
+import numpy as np
 import pandas as pd
 from utils import read_config, setup_logging
+from schema import (QUARTER_DTYPE, build_firm_lookup, compact_datastream, day_number_year,
+                    decode_for_output, to_day_number)
+from storage import read_output, write_output
+from bhr_index import build_return_index, window_bhr, window_label, year_bounds
+from market_index import (add_abnormal_returns, add_market_returns, firm_regions, load_or_build_market_index,
+                          market_columns, market_window_bhr)
+from dag import Stage, run_dag
+from sampling import firm_in_sample, sample_fraction, tag_output_paths
+from ordering import (ensure_sorted, firm_day_keys, mark_sorted, segment_ids, segment_reduce,
+                      segment_starts)
 
 log = setup_logging()
 
 def main():
     log.info("Preparing data for analysis ...")
-    cfg = read_config('config/prepare_data_cfg.yaml')
+    cfg = tag_output_paths(read_config('config/prepare_data_cfg.yaml'))
+    if sample_fraction(cfg) < 1:
+        log.info(f"Quick-look mode: keeping {sample_fraction(cfg):.1%} of firms; outputs are tagged accordingly.")
+
+    # The steps run as a DAG: each stage names its inputs and outputs, and independent
+    # stages (the three loads, the indexes, saving the final dataset) run concurrently.
+    stages = [
+        # Load the pulled datasets (Parquet if available, CSV otherwise). In quick-look mode the
+        # firm sample is drawn from the linking table and pushed down into the other two reads.
+        Stage("load_link", lambda: load_link(cfg), outputs=["link_ds_ws"]),
+        Stage("load_worldscope", lambda link_ds_ws: load_worldscope(cfg, link_ds_ws),
+              inputs=["link_ds_ws"], outputs=["ws_stock"]),
+        Stage("load_datastream", lambda link_ds_ws: load_datastream(cfg, link_ds_ws),
+              inputs=["link_ds_ws"], outputs=["ds2dsf_raw"]),
+
+        # Dense int32 firm ids and the compact Datastream panel
+        Stage("firm_lookup", lambda link_ds_ws, ds2dsf_raw: save_firm_lookup(link_ds_ws, ds2dsf_raw, cfg),
+              inputs=["link_ds_ws", "ds2dsf_raw"], outputs=["firm_lookup"]),
+        Stage("compact_datastream", lambda ds2dsf_raw, firm_lookup: compact_datastream(ds2dsf_raw, firm_lookup, cfg),
+              inputs=["ds2dsf_raw", "firm_lookup"], outputs=["ds2dsf"]),
+
+        # Prefix cumulative-return index: any window BHR becomes two lookups
+        Stage("return_index", lambda ds2dsf: save_return_index(ds2dsf, cfg),
+              inputs=["ds2dsf"], outputs=["return_index"]),
+        # Daily market returns per region (computed once and cached) for abnormal returns
+        Stage("market_index", lambda ds2dsf: (load_or_build_market_index(ds2dsf, cfg, datastream_source(cfg)),
+                                              firm_regions(ds2dsf)),
+              inputs=["ds2dsf"], outputs=["market_index", "regions"]),
+
+        # Step 1: Merge Worldscope with the Linking Table
+        Stage("merge_worldscope_link", merge_worldscope_link,
+              inputs=["ws_stock", "link_ds_ws"], outputs=["ws_link_merged"]),
+        # Step 2: Pivot dataset to long format
+        Stage("pivot_longer_earnings", pivot_longer_earnings, inputs=["ws_link_merged"], outputs=["ws_long"]),
+        # Step 3: Expand dataset for event windows (-1, 0, +1 days)
+        Stage("expand_event_window", lambda ws_long: expand_event_window(ws_long),
+              inputs=["ws_long"], outputs=["ws_expanded"]),
+        # Step 4: Merge with Datastream stock returns
+        Stage("merge_with_datastream", lambda ws_expanded, ds2dsf: merge_with_datastream(ws_expanded, ds2dsf),
+              inputs=["ws_expanded", "ds2dsf"], outputs=["merged_dataset"]),
+        # Step 5: Select firms that meet sample criteria (4 announcements per year)
+        Stage("select_firms_for_sample", lambda merged_dataset: select_firms_for_sample(merged_dataset),
+              inputs=["merged_dataset"], outputs=["final_dataset"]),
+
+        # Step 6: Compute and Save BHR (Event Window)
+        Stage("eawr_bhr", lambda final_dataset, market_index, regions: compute_and_save_eawr_bhr(final_dataset, cfg, market_index, regions),
+              inputs=["final_dataset", "market_index", "regions"], outputs=["bhr_event_results"]),
+        # Step 7: Extract annual stock return data for firms in BHR Event dataset
+        Stage("annual_stock_data", lambda bhr_event_results, ds2dsf: extract_annual_stock_data(bhr_event_results, ds2dsf, cfg),
+              inputs=["bhr_event_results", "ds2dsf"], outputs=["annual_stock_data"]),
+        # Step 8: Compute and Save BHR (Annual Return)
+        Stage("annual_bhr", lambda annual_stock_data, return_index, market_index, regions:
+              compute_and_save_annual_bhr(annual_stock_data, cfg, return_index, market_index, regions),
+              inputs=["annual_stock_data", "return_index", "market_index", "regions"], outputs=["bhr_annual_results"]),
+
+        # Step 9: Save the final dataset (full dataset with event windows), overlapping with the BHR steps
+        Stage("save_final_dataset", lambda final_dataset: write_output(
+                  decode_for_output(final_dataset), cfg, 'prepared_wrds_ds2dsf',
+                  cfg['prepared_wrds_ds2dsf_parquet'], cfg['prepared_wrds_ds2dsf_path']),
+              inputs=["final_dataset"]),
+    ]
+
+    # Optional: BHR over additional event windows for sensitivity analyses
+    if cfg.get('bhr_sensitivity_windows'):
+        stages.append(Stage("window_bhr", lambda bhr_event_results, return_index: compute_and_save_window_bhr(bhr_event_results, return_index, cfg),
+                            inputs=["bhr_event_results", "return_index"], outputs=["bhr_window_results"]))
+
+    run_dag(stages, max_workers=cfg.get('pipeline_workers', 4))
+
+    log.info("Preparing data for analysis ... Done!")
+
+
+def load_link(cfg):
+    """
+    Loads the Datastream/Worldscope linking table, keeping only the quick-look firm sample
+    (by hash of `infocode`) if `sample_fraction` is below 1.
+    """
+    link_ds_ws = read_output(cfg['link_ds_ws_save_path'], cfg['link_ds_ws_save_path_csv'])
+    if sample_fraction(cfg) < 1:
+        link_ds_ws = link_ds_ws.dropna(subset=["infocode"])
+        link_ds_ws = link_ds_ws[firm_in_sample(link_ds_ws["infocode"], sample_fraction(cfg))].reset_index(drop=True)
+        log.info(f"Quick-look sample: {link_ds_ws['infocode'].nunique()} firms in the linking table.")
+    return link_ds_ws
 
-    # Load the pulled datasets
-    ws_stock = pd.read_csv(cfg['worldscope_sample_save_path_csv'])
-    link_ds_ws = pd.read_csv(cfg['link_ds_ws_save_path_csv'])
-    ds2dsf = pd.read_csv(cfg['datastream_sample_save_path_csv'])
 
-    # Step 1: Merge Worldscope with the Linking Table
-    log.info("Merging Worldscope with Linking Table...")
-    ws_link_merged = merge_worldscope_link(ws_stock, link_ds_ws)
+def sample_filter(cfg, column, values):
+    """
+    Read filter restricting `column` to the sampled `values` (None for the full sample).
+    """
+    if sample_fraction(cfg) >= 1:
+        return None
+    return [(column, "in", sorted(int(v) for v in pd.unique(values.dropna())))]
 
-    # Step 2: Pivot dataset to long format
-    log.info("Pivoting merged dataset to long format...")
-    ws_long = pivot_longer_earnings(ws_link_merged)
 
-    # Step 3: Expand dataset for event windows (-1, 0, +1 days)
-    log.info("Expanding dataset for event windows...")
-    ws_expanded = expand_event_window(ws_long)
+def load_worldscope(cfg, link_ds_ws):
+    """
+    Loads the pulled Worldscope data, pushing the quick-look sample filter into the read.
+    """
+    return read_output(cfg['worldscope_sample_save_path'], cfg['worldscope_sample_save_path_csv'],
+                       filters=sample_filter(cfg, "code", link_ds_ws["code"]))
 
-    # Step 4: Merge with Datastream stock returns
-    log.info("Merging expanded dataset with Datastream stock returns...")
-    merged_dataset = merge_with_datastream(ws_expanded, ds2dsf)
 
-    # Step 5: Select firms that meet sample criteria
-    log.info("Selecting firms that meet the sample criteria (4 announcements per year)...")
-    final_dataset = select_firms_for_sample(merged_dataset)
+def load_datastream(cfg, link_ds_ws):
+    """
+    Loads the columns of the pulled Datastream panel used downstream and parses `marketdate`.
+    The quick-look sample filter is pushed into the read.
+    """
+    ds_columns = ["infocode", "marketdate", "ret", "region"]
+    if cfg.get('market_value_column'):
+        ds_columns.append(cfg['market_value_column'])
+    ds2dsf = read_output(cfg['datastream_sample_save_path'], cfg['datastream_sample_save_path_csv'], columns=ds_columns,
+                         filters=sample_filter(cfg, "infocode", link_ds_ws["infocode"]))
+    ds2dsf["marketdate"] = pd.to_datetime(ds2dsf["marketdate"], format="%m/%d/%y", errors="coerce")
+    return ds2dsf
 
-    # Step 6: Compute and Save BHR (Event Window)
-    bhr_event_results = compute_and_save_eawr_bhr(final_dataset, cfg)
 
-    # Step 7: Extract annual stock return data for firms in BHR Event dataset
-    annual_stock_data = extract_annual_stock_data(bhr_event_results, ds2dsf, cfg)
+def datastream_source(cfg):
+    """
+    Path of the pulled Datastream file that was loaded (Parquet if available, CSV otherwise).
+    """
+    if os.path.exists(cfg['datastream_sample_save_path']):
+        return cfg['datastream_sample_save_path']
+    return cfg['datastream_sample_save_path_csv']
 
-    # Step 8: Compute and Save BHR (Annual Return)
-    bhr_annual_results = compute_and_save_annual_bhr(cfg)
 
-    # Step 9: Save the final dataset (full dataset with event windows)
-    final_dataset.to_csv(cfg['prepared_wrds_ds2dsf_path'], index=False)
-    final_dataset.to_parquet(cfg['prepared_wrds_ds2dsf_parquet'], index=False)
+def save_firm_lookup(link_ds_ws, ds2dsf, cfg):
+    """
+    Builds and saves the lookup table of dense int32 firm ids shared by all steps.
+    """
+    firm_lookup = build_firm_lookup(link_ds_ws["infocode"], ds2dsf["infocode"])
+    firm_lookup.to_parquet(cfg['firm_lookup_parquet'], index=False)
+    log.info(f"Firm lookup table with {len(firm_lookup)} firms saved to {cfg['firm_lookup_parquet']}")
+    return firm_lookup
 
-    log.info(f"Final dataset saved to {cfg['prepared_wrds_ds2dsf_path']} (CSV) and {cfg['prepared_wrds_ds2dsf_parquet']} (Parquet)")
 
-    log.info("Preparing data for analysis ... Done!")
+def save_return_index(ds2dsf, cfg):
+    """
+    Builds and saves the prefix cumulative-return index of the compact daily panel.
+    """
+    log.info(f"Compact Datastream panel: {len(ds2dsf)} rows, {ds2dsf.memory_usage(deep=True).sum() / 1e6:.1f} MB")
+    return_index = build_return_index(ds2dsf)
+    write_output(return_index, cfg, 'return_index', cfg['return_index_parquet'])
+    return return_index
 
 
 def merge_worldscope_link(ws_stock, link_ds_ws):
@@ -61,6 +173,7 @@ def merge_worldscope_link(ws_stock, link_ds_ws):
     Merge Worldscope stock data with the linking table.
     Uses `code` (QA ID for Worldscope) to join with the linking table.
     Keeps only the relevant columns: year_, item6105, item5901, item5902, item5903, item5904, infocode.
+    The announcement rows are keyed by `infocode` alone; `firm_id` stays on the daily panel.
     """
     # Merge datasets
     ws_link_merged = ws_stock.merge(link_ds_ws, left_on="code", right_on="code", how="inner")
@@ -68,9 +181,13 @@ def merge_worldscope_link(ws_stock, link_ds_ws):
 
     # Keep only relevant columns
     selected_columns = ["year_", "item6105", "item5901", "item5902", "item5903", "item5904", "infocode"]
-    ws_link_merged = ws_link_merged[selected_columns]
+    ws_link_merged = ws_link_merged[selected_columns].dropna(subset=["infocode"])
     log.info(f"Filtered merged dataset to keep only relevant columns: {selected_columns}")
 
+    # Compact identifiers: int16 year, int32 infocode and the Worldscope id as a categorical,
+    # since it is only carried through to the output and is copied for every event window
+    ws_link_merged = ws_link_merged.astype({"year_": np.int16, "infocode": np.int32, "item6105": "category"})
+
     return ws_link_merged
 
 def pivot_longer_earnings(ws_link_merged):
@@ -94,7 +211,7 @@ def pivot_longer_earnings(ws_link_merged):
         "item5903": "Q3",
         "item5904": "Q4"
     }
-    ws_long["quarter"] = ws_long["quarter"].map(quarter_mapping)
+    ws_long["quarter"] = ws_long["quarter"].map(quarter_mapping).astype(QUARTER_DTYPE)
 
     # Log transformation
     log.info(f"Pivoted dataset. New number of rows: {len(ws_long)}")
@@ -105,6 +222,8 @@ def expand_event_window(df):
     """
     Expands dataset by adding -3 to +3 day event windows for each earnings announcement.
     If `ret = 0` on Day 0, shift `event_date` to the next available trading day.
+    `rdq` and `event_date` are stored as int32 day numbers and `event_window` as int8.
+    The expanded panel is in (infocode, rdq, event_window) order, which the later steps rely on.
     """
     log.info("Expanding dataset to include extended event windows (-3 to +3 days)...")
 
@@ -118,33 +237,37 @@ def expand_event_window(df):
 
     # Drop NaT values to avoid issues in expansion
     df = df.dropna(subset=["rdq"]).copy()
+    df["rdq"] = to_day_number(df["rdq"])
+
+    # Establish the announcement order once; the steps below only filter and left-merge
+    df = df.sort_values(["infocode", "rdq"], kind="stable")
 
     # Define the extended event window offsets (-3 to +3)
-    offsets = [-3, -2, -1, 0, 1, 2, 3]
+    offsets = np.arange(-3, 4, dtype=np.int8)
 
-    # Generate new rows efficiently using pandas repeat + offsets
-    df_expanded = df.loc[df.index.repeat(len(offsets))].reset_index(drop=True)
-    df_expanded["event_window"] = offsets * (len(df))  # Apply offsets
-    df_expanded["event_date"] = df_expanded["rdq"] + pd.to_timedelta(df_expanded["event_window"], unit="D")
+    # Generate new rows efficiently using positional repeat + tiled offsets
+    df_expanded = df.iloc[np.repeat(np.arange(len(df)), len(offsets))].reset_index(drop=True)
+    df_expanded["event_window"] = np.tile(offsets, len(df))  # Apply offsets
+    df_expanded["event_date"] = (df_expanded["rdq"] + df_expanded["event_window"]).astype(np.int32)
+    mark_sorted(df_expanded, ["infocode", "rdq", "event_window"])
 
-    log.info(f"Expanded dataset. New number of rows: {len(df_expanded)}")
+    log.info(f"Expanded dataset. New number of rows: {len(df_expanded)}, "
+             f"memory: {df_expanded.memory_usage(deep=True).sum() / 1e6:.1f} MB")
     return df_expanded
 
 
 def merge_with_datastream(df_expanded, ds2dsf):
     """
-    Merge expanded dataset with Datastream stock returns using `infocode` and `event_date`,
+    Merge expanded dataset with the compact Datastream panel using `infocode` and `event_date`,
     then adjust `event_date` for missing stock returns (`ret = 0`), ensuring continuous shifting.
     If no valid trading day is found for Day 0, the entire event window (-3 to +3) is dropped.
     Finally, removes event windows (-3, -2, +2, +3) as they are no longer needed.
     """
     log.info("Merging with Datastream stock returns...")
 
-    # Ensure marketdate is in datetime format
-    ds2dsf["marketdate"] = pd.to_datetime(ds2dsf["marketdate"], format="%m/%d/%y", errors="coerce")
-
-    # Merge on `infocode` and `event_date` = `marketdate`
-    df_final = df_expanded.merge(ds2dsf, left_on=["infocode", "event_date"], right_on=["infocode", "marketdate"], how="left")
+    # Merge on `infocode` and `event_date` = `marketdate`, carrying only the return column over
+    ds_returns = ds2dsf[["infocode", "marketdate", "ret"]].rename(columns={"marketdate": "event_date"})
+    df_final = df_expanded.merge(ds_returns, on=["infocode", "event_date"], how="left")
 
     # Check for unmatched event dates (missing stock return data)
     missing_ret_count = df_final["ret"].isna().sum()
@@ -160,34 +283,26 @@ def merge_with_datastream(df_expanded, ds2dsf):
     # List of infocode & year_ pairs where no valid trading day is found
     failed_rdq_infocode_pairs = []
 
-    # **SHIFTING MECHANISM** - Adjusts Day 0 first, then Day -1 and Day +1 dynamically
-    for index, row in zero_ret_rows.iterrows():
-        new_date = row["event_date"]
-        shifted = False  # Track if shifting was successful
-
-        while True:
-            # Get the next available trading date with `ret != 0`
-            possible_dates = df_final[
-                (df_final["infocode"] == row["infocode"]) & 
-                (df_final["event_date"] > new_date) & 
-                (df_final["ret"] != 0)
-            ].sort_values(by="event_date")
-
-            if not possible_dates.empty:
-                new_date = possible_dates.iloc[0]["event_date"]  # Update event_date
-                new_ret = possible_dates.iloc[0]["ret"]
-
-                # Ensure `ret != 0`
-                if new_ret != 0:
-                    df_final.at[index, "event_date"] = new_date
-                    df_final.at[index, "ret"] = new_ret
-                    shifted = True  # Mark as shifted
-                    break  # Exit loop once a valid date is found
-
-            else:
-                log.warning(f"No valid trading day found for infocode {row['infocode']} on {row['event_date']}. Marking for full window removal.")
-                failed_rdq_infocode_pairs.append((row["infocode"], row["year_"]))
-                break  # Exit loop if no more valid dates exist
+    # **SHIFTING MECHANISM** - Moves each zero-return day to the firm's next date with `ret != 0`
+    # in the merged panel. The candidate (firm, date) pairs are sorted once and every
+    # zero-return row is a binary search for the first candidate after its date.
+    candidates = df_final.loc[df_final["ret"] != 0, ["infocode", "event_date", "ret"]]
+    candidate_keys, first = np.unique(firm_day_keys(candidates["infocode"], candidates["event_date"]), return_index=True)
+    candidate_dates = candidates["event_date"].to_numpy()[first]
+    candidate_rets = candidates["ret"].to_numpy()[first]
+
+    zero_firms = zero_ret_rows["infocode"].to_numpy()
+    pos = np.searchsorted(candidate_keys, firm_day_keys(zero_firms, zero_ret_rows["event_date"]), side="right")
+    found = pos < len(candidate_keys)
+    found[found] = (candidate_keys[pos[found]] >> 32) == zero_firms[found]
+
+    shifted = zero_ret_rows.index[found]
+    df_final.loc[shifted, "event_date"] = candidate_dates[pos[found]]
+    df_final.loc[shifted, "ret"] = candidate_rets[pos[found]]
+
+    for _, row in zero_ret_rows[~found].iterrows():
+        log.warning(f"No valid trading day found for infocode {row['infocode']} on {row['event_date']}. Marking for full window removal.")
+        failed_rdq_infocode_pairs.append((row["infocode"], row["year_"]))
 
     # **NEW STEP: Remove full event windows (-3 to +3) if no valid trading day was found**
     if failed_rdq_infocode_pairs:
@@ -204,11 +319,6 @@ def merge_with_datastream(df_expanded, ds2dsf):
     df_final = df_final[df_final["event_window"].isin([-1, 0, 1])]
     log.info("Dropped event windows (-3, -2, +2, +3) as they are no longer needed.")
 
-    # Drop unnecessary variables after merging
-    drop_columns = ["region", "typecode", "dscode", "marketdate"]
-    df_final = df_final.drop(columns=drop_columns, errors="ignore")
-    log.info(f"Dropped unnecessary columns: {drop_columns}")
-
     # **CHECK FOR DUPLICATES**
     duplicate_rows = df_final[df_final.duplicated()]
     num_duplicate_rows = len(duplicate_rows)
@@ -229,27 +339,25 @@ def select_firms_for_sample(df):
     """
     Filters dataset to retain firms with exactly four earnings announcements per year.
     Ensures all four announcements fall within the same calendar year and belong to unique quarters (Q1, Q2, Q3, Q4).
+    Firm-years are contiguous segments of the (infocode, rdq)-ordered panel.
     """
     log.info("Selecting firms that meet the sample criteria (4 earnings announcements per year)...")
 
-    # Ensure `rdq` is in datetime format
-    df["rdq"] = pd.to_datetime(df["rdq"], errors="coerce")
-
-    # Extract the announcement year from `rdq`
-    df["rdq_year"] = df["rdq"].dt.year
-
-    # Keep only observations where event_window = 0 (earnings announcement day)
-    df_event_0 = df[df["event_window"] == 0].copy()
+    df = ensure_sorted(df, ["infocode", "rdq", "event_window"], "announcement panel")
 
-    # Count unique quarters per firm-year where event_window == 0
-    firm_rdq_counts = df_event_0.groupby(["infocode", "rdq_year"])["quarter"].nunique().reset_index()
+    # Extract the announcement year from `rdq` (day number)
+    df["rdq_year"] = day_number_year(df["rdq"])
 
-    # Identify firms that have exactly 4 unique quarters (Q1, Q2, Q3, Q4)
-    valid_firms = firm_rdq_counts[firm_rdq_counts["quarter"] == 4]
+    # Bit mask of the quarters announced on event_window == 0 in each firm-year segment
+    firm_years = segment_starts(df, ["infocode", "rdq_year"])
+    codes = df["quarter"].cat.codes.to_numpy().astype(np.int64)
+    announced = (df["event_window"].to_numpy() == 0) & (codes >= 0)
+    quarter_bits = np.where(announced, np.left_shift(1, np.maximum(codes, 0)), 0)
+    quarters_seen = segment_reduce(np.bitwise_or, quarter_bits, firm_years)
 
-
-    # Merge back with the main dataset to keep only these firms
-    df_filtered = df.merge(valid_firms[["infocode", "rdq_year"]], on=["infocode", "rdq_year"], how="inner")
+    # Keep only firm-years with all four quarters (Q1, Q2, Q3, Q4)
+    valid_firm_years = quarters_seen == 0b1111
+    df_filtered = df[valid_firm_years[segment_ids(firm_years, len(df))]].reset_index(drop=True)
 
     # Print the total number of unique firms after filtering
     unique_firms_after = df_filtered["infocode"].nunique()
@@ -259,62 +367,65 @@ def select_firms_for_sample(df):
 
     return df_filtered
 
-def compute_and_save_eawr_bhr(df, cfg):
+def compute_and_save_eawr_bhr(df, cfg, market_index, regions):
     """
     Computes the Earnings Announcement Window Return (EAWR) as the 
     buy-and-hold return (BHR) over the three-day event window (-1,0,+1).
-    Retains the `quarter` column and saves the output directly to CSV & Parquet.
+    Adds market-adjusted returns (ABHR_3day_EW/_VW): BHR_3day minus the market BHR
+    over the same three (shifted) trading days.
+    Retains the `quarter` column and saves the output in the configured formats.
     """
     log.info("Computing and saving Earnings Announcement Window Returns (3-day BHR)...")
 
-    # Ensure dataset is sorted properly
-    df = df.sort_values(by=["infocode", "rdq", "event_window"])
-
-    # Group by firm and earnings announcement date
-    bhr_results = []
-    
-    for (infocode, rdq), group in df.groupby(["infocode", "rdq"]):
-        # Ensure all required event windows (-1, 0, +1) are present
-        if set(group["event_window"]) == {-1, 0, 1}:  
-            try:
-                ret_neg1 = group.loc[group["event_window"] == -1, "ret"].values[0]
-                ret_0 = group.loc[group["event_window"] == 0, "ret"].values[0]
-                ret_1 = group.loc[group["event_window"] == 1, "ret"].values[0]
-
-                # Retrieve quarter information (same across event window)
-                quarter = group["quarter"].iloc[0]  
-
-                # Compute BHR_3day
-                bhr_3day = (1 + ret_neg1) * (1 + ret_0) * (1 + ret_1) - 1
-
-                # Append results with quarter info
-                bhr_results.append({
-                    "infocode": infocode,
-                    "rdq": rdq,
-                    "quarter": quarter,  # Retain quarter for regression later
-                    "BHR_3day": bhr_3day
-                })
-            except Exception as e:
-                log.warning(f"Skipping {infocode} on {rdq} due to missing data: {e}")
-    
-    # Convert to DataFrame
-    df_bhr = pd.DataFrame(bhr_results)
+    # Each announcement is a contiguous segment of the (infocode, rdq, event_window)-ordered
+    # panel, with one run of rows per event window
+    df = df[df["event_window"].isin([-1, 0, 1])]
+    df = ensure_sorted(df.reset_index(drop=True), ["infocode", "rdq", "event_window"], "announcement panel")
+    announcements = segment_starts(df, ["infocode", "rdq"])
+    window_runs = segment_starts(df, ["infocode", "rdq", "event_window"])
+    first_run = np.searchsorted(window_runs, announcements)
+
+    # Keep announcements with all required event windows (-1, 0, +1)
+    complete = np.diff(np.append(first_run, len(window_runs))) == 3
+    run = first_run[complete]
+    window_rows = (window_runs[run], window_runs[run + 1], window_runs[run + 2])
+    ret = df["ret"].to_numpy()
+    ret_neg1, ret_0, ret_1 = (ret[rows] for rows in window_rows)
+
+    # Several rows per event window (e.g. two Worldscope codes linked to one infocode):
+    # the first row of each window is used for both the stock and the market leg
+    duplicated = (np.diff(np.append(announcements, len(df)))[complete] > 3).sum()
+    if duplicated:
+        log.warning(f"{duplicated} announcements have more than one row per event window; "
+                    f"using the first row of each window.")
+
+    # Compact schema: int32 infocode and rdq day number, categorical quarter (retained for regression later)
+    first_rows = df.iloc[window_rows[0]]
+    df_bhr = pd.DataFrame({
+        "infocode": first_rows["infocode"].to_numpy(dtype=np.int32),
+        "rdq": first_rows["rdq"].to_numpy(dtype=np.int32),
+        "quarter": pd.Categorical(first_rows["quarter"], dtype=QUARTER_DTYPE),
+        "BHR_3day": ((1 + ret_neg1) * (1 + ret_0) * (1 + ret_1) - 1).astype(df["ret"].dtype),
+    })
 
     log.info(f"Computed {len(df_bhr)} earnings announcement window returns. Quarter column is retained.")
 
+    # Market BHR over the same three event dates, joined from the daily market index (left merges keep the row order)
+    market_rows = add_market_returns(df[["infocode", "rdq", "event_date"]], market_index, regions, "event_date")
+    mkt_cols = market_columns(market_index)
+    market_log = np.log1p(market_rows[mkt_cols].to_numpy(dtype=np.float64))
+    market_log[np.isnan(market_log)] = 0.0
+    market_3day = pd.DataFrame(np.expm1(sum(market_log[rows] for rows in window_rows)), columns=mkt_cols)
+    df_bhr = add_abnormal_returns(df_bhr, market_3day, "BHR_3day", "ABHR_3day")
+    abnormal_cols = [c for c in df_bhr.columns if c.startswith("ABHR_3day")]
+    df_bhr[abnormal_cols] = df_bhr[abnormal_cols].astype(df["ret"].dtype)
+
     # SAVE THE OUTPUT
     # Keep only relevant columns (Include `quarter` for regression use)
-    df_bhr_filtered = df_bhr[["infocode", "rdq", "quarter", "BHR_3day"]]
-
-    # Save dataset paths from config
-    bhr_csv_path = cfg["bhr_event_output_csv"]
-    bhr_parquet_path = cfg["bhr_event_output_parquet"]
+    df_bhr_filtered = decode_for_output(df_bhr[["infocode", "rdq", "quarter", "BHR_3day"] + abnormal_cols])
 
-    # Save as CSV and Parquet
-    df_bhr_filtered.to_csv(bhr_csv_path, index=False)
-    df_bhr_filtered.to_parquet(bhr_parquet_path, index=False)
-
-    log.info(f"BHR dataset saved to {bhr_csv_path} (CSV) and {bhr_parquet_path} (Parquet). Quarter column is retained.")
+    # Save with the configured writer (paths from config)
+    write_output(df_bhr_filtered, cfg, 'bhr_event', cfg["bhr_event_output_parquet"], cfg["bhr_event_output_csv"])
 
     return df_bhr
 
@@ -328,21 +439,20 @@ def extract_annual_stock_data(bhr_event_results, ds2dsf, cfg):
 
     ## Extract Unique Firms & Years from BHR Event Dataset
     selected_firms = bhr_event_results[["infocode", "rdq"]].copy()
-    selected_firms["year_bhr"] = pd.to_datetime(selected_firms["rdq"]).dt.year  # Extract year from `rdq`
+    selected_firms["year_bhr"] = day_number_year(selected_firms["rdq"])  # Extract year from `rdq`
     # Drop duplicates to ensure unique firm-year pairs
     selected_firms = selected_firms.drop_duplicates(subset=["infocode", "year_bhr"])  
     log.info(f"Selected {len(selected_firms)} unique firm-year pairs from BHR Event dataset.")
     log.info(f"Sample of firm-year pairs:\n{selected_firms.head(20).to_string()}")
 
-    ## Load Full Stock Dataset (Unfiltered Datastream Data)
-    ds2dsf["marketdate"] = pd.to_datetime(ds2dsf["marketdate"], errors="coerce")  # Ensure datetime format
-    ds2dsf["year_stock"] = ds2dsf["marketdate"].dt.year  # Extract year for filtering
+    ## Full Stock Dataset (Unfiltered compact Datastream panel)
     log.info(f" Total records in stock return dataset: {len(ds2dsf)}")
 
     ## FILTER Stock Data (Strict Matching on infocode & year)
     filtered_stock_data = ds2dsf[
         ds2dsf["infocode"].isin(selected_firms["infocode"])
     ].copy()
+    filtered_stock_data["year_stock"] = day_number_year(filtered_stock_data["marketdate"])  # Extract year for filtering
 
     # Now filter the years based on firm-specific years from BHR Event dataset
     filtered_stock_data = filtered_stock_data.merge(
@@ -372,78 +482,79 @@ def extract_annual_stock_data(bhr_event_results, ds2dsf, cfg):
     filtered_stock_data = filtered_stock_data[relevant_columns]
 
     ## Save the Filtered Dataset
-    annual_stock_csv_path = cfg["annual_stock_data_csv"]
-    annual_stock_parquet_path = cfg["annual_stock_data_parquet"]
-
-    filtered_stock_data.to_csv(annual_stock_csv_path, index=False)
-    filtered_stock_data.to_parquet(annual_stock_parquet_path, index=False)
+    write_output(decode_for_output(filtered_stock_data), cfg, 'annual_stock_data',
+                 cfg["annual_stock_data_parquet"], cfg["annual_stock_data_csv"])
 
     log.info(f"Final row count of filtered annual stock data: {len(filtered_stock_data)}")
-    log.info(f"Annual stock data saved to:\n- {annual_stock_csv_path} (CSV)\n- {annual_stock_parquet_path} (Parquet).")
 
     return filtered_stock_data
 
-def compute_and_save_annual_bhr(cfg):
+def compute_and_save_annual_bhr(annual_stock_data, cfg, return_index, market_index, regions):
     """
     Computes the Annual Buy-and-Hold Return (BHR_Annual) using daily stock returns.
-    Retains the `year_stock` column and saves the output directly to CSV & Parquet.
+    Each firm-year of the (infocode, marketdate)-ordered annual stock data is a calendar-year
+    window query on the prefix return index.
+    Adds market-adjusted returns (ABHR_Annual_EW/_VW): BHR_Annual minus the market BHR of
+    the firm's region from the firm's first to its last trading day in the year.
+    Retains the `year_stock` column and saves the output in the configured formats.
     """
     log.info("Computing and saving Annual Buy-and-Hold Returns (BHR_Annual)...")
 
-    # Load the filtered annual stock data
-    annual_stock_data = pd.read_csv(cfg["annual_stock_data_csv"])
-    log.info(f"Loaded annual stock data. Total records: {len(annual_stock_data)}")
-
-    # Ensure `marketdate` is in datetime format
-    annual_stock_data["marketdate"] = pd.to_datetime(annual_stock_data["marketdate"], errors="coerce")
-
-    # Sort data for correct computation order
-    annual_stock_data = annual_stock_data.sort_values(by=["infocode", "year_stock", "marketdate"])
+    # Firm-years of the filtered annual stock data, taken from the frame in memory: the saved
+    # file is partitioned by year_stock and would read back year-major
+    annual_stock_data = annual_stock_data[["infocode", "year_stock"]]
+    log.info(f"Annual stock data: {len(annual_stock_data)} records.")
 
     # Verify available years
     log.info("Sample of available years in the dataset:")
     log.info(annual_stock_data["year_stock"].value_counts().sort_index())
 
-    # Compute Buy-and-Hold Annual Return (BHR_Annual)
-    bhr_annual_results = []
-
-    for (infocode, year_stock), group in annual_stock_data.groupby(["infocode", "year_stock"]):
-        try:
-            # Ensure sorted data for proper calculation
-            group = group.sort_values(by="marketdate")
-
-            # Compute BHR_Annual using cumulative product of (1 + daily return) - 1
-            bhr_annual = (group["ret"] + 1).prod() - 1
-
-            # Append results
-            bhr_annual_results.append({
-                "infocode": infocode,
-                "year_stock": year_stock,
-                "BHR_Annual": bhr_annual
-            })
-        except Exception as e:
-            log.warning(f"Skipping {infocode} for {year_stock} due to missing data: {e}")
-
-    # Convert results to DataFrame
-    df_bhr_annual = pd.DataFrame(bhr_annual_results)
+    # Compute Buy-and-Hold Annual Return (BHR_Annual) as one batch of calendar-year window queries
+    df_bhr_annual = ensure_sorted(annual_stock_data.drop_duplicates().reset_index(drop=True),
+                                  ["infocode", "year_stock"], "annual firm-years")
+    df_bhr_annual = df_bhr_annual.astype({"infocode": np.int32, "year_stock": np.int16})
+    year_start, year_end = year_bounds(df_bhr_annual["year_stock"])
+    bhr = window_bhr(return_index, df_bhr_annual["infocode"], year_start, year_end)
+    df_bhr_annual["BHR_Annual"] = bhr["BHR"].astype(return_index["ret"].dtype)
+
+    # Market BHR of each firm's region over the firm's own trading days in the year, so firms
+    # that list, delist or stop trading mid-year are compared with the same window
+    firm_market = market_window_bhr(market_index, regions, df_bhr_annual["infocode"], bhr["first_day"], bhr["last_day"])
+    df_bhr_annual = add_abnormal_returns(df_bhr_annual, firm_market, "BHR_Annual", "ABHR_Annual")
+    abnormal_cols = [c for c in df_bhr_annual.columns if c.startswith("ABHR_Annual")]
+    df_bhr_annual[abnormal_cols] = df_bhr_annual[abnormal_cols].astype(return_index["ret"].dtype)
 
     log.info(f"Computed {len(df_bhr_annual)} annual buy-and-hold returns.")
 
     # Save the output
     # Keep only relevant columns
-    df_bhr_annual_filtered = df_bhr_annual[["infocode", "year_stock", "BHR_Annual"]]
+    df_bhr_annual_filtered = df_bhr_annual[["infocode", "year_stock", "BHR_Annual"] + abnormal_cols]
+
+    # Save with the configured writer (paths from config)
+    write_output(df_bhr_annual_filtered, cfg, 'bhr_annual', cfg["bhr_annual_output_parquet"], cfg["bhr_annual_output_csv"])
 
-    # Save dataset paths from config
-    bhr_annual_csv_path = cfg["bhr_annual_output_csv"]
-    bhr_annual_parquet_path = cfg["bhr_annual_output_parquet"]
+    return df_bhr_annual
+
+def compute_and_save_window_bhr(bhr_event_results, return_index, cfg):
+    """
+    Computes buy-and-hold returns around each earnings announcement for the event windows
+    listed in `bhr_sensitivity_windows` (calendar-day offsets relative to `rdq`, both ends
+    inclusive), e.g. (-1,+1), (0,+2) and (-5,+5), using the prefix return index.
+    Unlike BHR_3day, days with zero returns are not shifted.
+    """
+    log.info("Computing buy-and-hold returns for sensitivity event windows...")
 
-    # Save as CSV and Parquet
-    df_bhr_annual_filtered.to_csv(bhr_annual_csv_path, index=False)
-    df_bhr_annual_filtered.to_parquet(bhr_annual_parquet_path, index=False)
+    df_windows = bhr_event_results[["infocode", "rdq", "quarter"]].copy()
+    for start, end in cfg["bhr_sensitivity_windows"]:
+        bhr = window_bhr(return_index, df_windows["infocode"], df_windows["rdq"] + start, df_windows["rdq"] + end)
+        df_windows[window_label((start, end))] = bhr["BHR"].to_numpy()
 
-    log.info(f"BHR Annual dataset saved to:\n- {bhr_annual_csv_path} (CSV)\n- {bhr_annual_parquet_path} (Parquet).")
+    log.info(f"Computed {len(cfg['bhr_sensitivity_windows'])} window BHRs for {len(df_windows)} announcements.")
 
-    return df_bhr_annual
+    write_output(decode_for_output(df_windows), cfg, 'bhr_windows',
+                 cfg["bhr_window_output_parquet"], cfg["bhr_window_output_csv"])
+
+    return df_windows
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
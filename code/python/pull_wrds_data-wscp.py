@@ -6,9 +6,7 @@
 import os
 from getpass import getpass
 import dotenv
-import pandas as pd
 from utils import read_config, setup_logging
-import wrds
 
 log = setup_logging()
 
@@ -19,23 +17,25 @@ def main():
     This function reads the configuration file, gets the WRDS login credentials, 
     and pulls the data from WRDS.
 
-    The data is then saved to CSV and Parquet files.
+    The data is then saved in the formats configured under `output_writer`.
+    Queries are served from the local WRDS cache when possible, and the login is
+    only requested once a query has to go to WRDS.
     """
     cfg = read_config('config/pull_data_cfg.yaml')
-    wrds_login = get_wrds_login()
-    
-    # Pull data from WRDS
-    worldscope_df, ds_df, linkdata_df = pull_wrds_data(cfg, wrds_login)
-
-    # Save pulled data
-    worldscope_df.to_csv(cfg['worldscope_sample_save_path_csv'], index=False)
-    worldscope_df.to_parquet(cfg['worldscope_sample_save_path'], index=False)
 
-    ds_df.to_csv(cfg['datastream_sample_save_path_csv'], index=False)
-    ds_df.to_parquet(cfg['datastream_sample_save_path'], index=False)
+    # Pull data from WRDS (pandas/pyarrow are only loaded once we are about to pull)
+    from wrds_cache import CachedConnection
+    db = CachedConnection(cfg, lambda: connect_wrds(get_wrds_login()))
+    worldscope_df, ds_df, linkdata_df = pull_wrds_data(cfg, db)
 
-    linkdata_df.to_csv(cfg['link_ds_ws_save_path_csv'], index=False)
-    linkdata_df.to_parquet(cfg['link_ds_ws_save_path'], index=False)
+    # Save pulled data (pandas/pyarrow are only loaded once there is data to write)
+    from storage import write_output
+    write_output(worldscope_df, cfg, 'worldscope', cfg['worldscope_sample_save_path'],
+                 cfg['worldscope_sample_save_path_csv'])
+    write_output(ds_df, cfg, 'datastream', cfg['datastream_sample_save_path'],
+                 cfg['datastream_sample_save_path_csv'])
+    write_output(linkdata_df, cfg, 'link_ds_ws', cfg['link_ds_ws_save_path'],
+                 cfg['link_ds_ws_save_path_csv'])
 
 
 def get_wrds_login():
@@ -53,18 +53,27 @@ def get_wrds_login():
     return {'wrds_username': wrds_username, 'wrds_password': wrds_password}
 
 
-def pull_wrds_data(cfg, wrds_authentication):
+def connect_wrds(wrds_authentication):
     """
-    Pulls data from WRDS (Worldscope, Datastream, and linking table).
+    Opens the WRDS connection.
     """
+    import wrds  # Slow to import, so only loaded once we are about to connect
+
     db = wrds.Connection(
         wrds_username=wrds_authentication['wrds_username'], 
         wrds_password=wrds_authentication['wrds_password']
     )
     
     log.info("Logged on to WRDS ...")
+    return db
 
 
+def pull_wrds_data(cfg, db):
+    """
+    Pulls data from WRDS (Worldscope, Datastream, and linking table)
+    through `db`, a WRDS connection or the cached connection.
+    """
+
     log.info("Pulling Worldscope data ... ")
     # Prepare the variables and filters for the WRDS Worldscope stock data query
     if cfg.get('wrds_ws_stock_vars'):
@@ -108,7 +117,6 @@ def pull_wrds_data(cfg, wrds_authentication):
     log.info("Pulling link data WSCP/DS... Done!")
 
     db.close()
-    log.info("Disconnected from WRDS")
 
 
     return worldscope_df, ds_df, linkdata_df
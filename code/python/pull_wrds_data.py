@@ -8,9 +8,7 @@ import os
 from getpass import getpass
 import dotenv
 
-import pandas as pd
 from utils import read_config, setup_logging
-import wrds
 
 log = setup_logging()
 
@@ -21,24 +19,33 @@ def main():
     This function reads the configuration file, gets the WRDS login credentials, and pulls the data from WRDS.
 
     The data is then saved to CSV and Parquet files.
+    Queries are served from the local WRDS cache when possible, and the login is
+    only requested once a query has to go to WRDS.
     '''
     cfg = read_config('config/pull_data_cfg.yaml')
-    wrds_login = get_wrds_login()
     
     # Pull CRSP and Compustat Data
-    db = wrds.Connection(
-        wrds_username=wrds_login['wrds_username'], 
-        wrds_password=wrds_login['wrds_password']
-    )
-    
-    log.info('Logged on to WRDS ...')
+    from wrds_cache import CachedConnection
+    db = CachedConnection(cfg, lambda: connect_wrds(get_wrds_login()))
     
     pull_crsp_data(cfg, db)
     pull_compustat_data(cfg, db)
     pull_link_data(db)
     
     db.close()
-    log.info("Disconnected from WRDS")
+
+def connect_wrds(wrds_login):
+    '''
+    Opens the WRDS connection.
+    '''
+    import wrds  # Slow to import, so only loaded once we are about to connect
+    db = wrds.Connection(
+        wrds_username=wrds_login['wrds_username'], 
+        wrds_password=wrds_login['wrds_password']
+    )
+    
+    log.info('Logged on to WRDS ...')
+    return db
 
 def get_wrds_login():
     '''
@@ -0,0 +1,59 @@
+import os
+import numpy as np
+
+# Quick-look mode: keep a deterministic fraction of firms, chosen by a hash of `infocode`.
+# The hash only depends on the infocode, so a firm is in the same subsample on every run,
+# in every country and for every data vintage, which keeps quick-look results comparable.
+
+# Outputs under these directories get the sample tag in their file name
+TAGGED_DIRS = ("data/generated/", "output/")
+
+
+def sample_fraction(cfg):
+    '''
+    Returns the configured `sample_fraction` (1.0 = full sample).
+    '''
+    fraction = float(cfg.get('sample_fraction') or 1.0)
+    if not 0 < fraction <= 1:
+        raise ValueError(f"sample_fraction must be in (0, 1], got {fraction}")
+    return fraction
+
+
+def firm_in_sample(infocodes, fraction):
+    '''
+    Boolean mask of the infocodes in the quick-look sample (splitmix64 hash mapped to [0, 1)).
+    '''
+    x = np.asarray(infocodes, dtype=np.int64).astype(np.uint64)
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+    uniform = (x >> np.uint64(11)).astype(np.float64) / float(2 ** 53)
+    return uniform < fraction
+
+
+def sample_tag(fraction):
+    '''
+    File name tag for a sampling fraction, e.g. 0.05 -> "_sample5pct" ("" for the full sample).
+    '''
+    if fraction >= 1:
+        return ""
+    pct = f"{fraction * 100:g}".replace(".", "p")
+    return f"_sample{pct}pct"
+
+
+def tag_output_paths(cfg):
+    '''
+    Returns a copy of the config with the sample tag added to every generated and output
+    path, so quick-look results never overwrite the full-sample ones.
+    '''
+    tag = sample_tag(sample_fraction(cfg))
+    if not tag:
+        return cfg
+    tagged = dict(cfg)
+    for key, value in cfg.items():
+        if isinstance(value, str) and value.startswith(TAGGED_DIRS):
+            root, ext = os.path.splitext(value)
+            tagged[key] = f"{root}{tag}{ext}"
+    return tagged
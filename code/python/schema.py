@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+from utils import setup_logging
+from ordering import is_sorted, mark_sorted
+
+log = setup_logging()
+
+# Compact panel schema shared by the prepare and analysis steps:
+# - dense int32 firm ids (`firm_id`) with a lookup table back to `infocode`
+# - int8 event offsets and a categorical `quarter`
+# - int32 day numbers (days since 1970-01-01) for `rdq`, `event_date` and `marketdate`
+# - int16 calendar years
+# - float32 or float64 returns, as configured
+QUARTERS = ["Q1", "Q2", "Q3", "Q4"]
+QUARTER_DTYPE = pd.CategoricalDtype(QUARTERS, ordered=True)
+DATE_COLUMNS = ["rdq", "event_date", "marketdate"]
+YEAR_COLUMNS = ["year_", "rdq_year", "year_stock"]
+
+
+def return_dtype(cfg):
+    '''
+    Returns the configured dtype for stock returns (float32 or float64).
+    '''
+    dtype = np.dtype(cfg.get('return_dtype', 'float64'))
+    if dtype not in (np.float32, np.float64):
+        raise ValueError(f"return_dtype must be float32 or float64, got {dtype}")
+    return dtype
+
+
+def to_day_number(dates):
+    '''
+    Converts datetimes to int32 day numbers. Missing dates must be dropped beforehand.
+    '''
+    days = pd.to_datetime(dates).values.astype('datetime64[D]').astype(np.int64)
+    return pd.Series(days.astype(np.int32), index=dates.index, name=dates.name)
+
+
+def from_day_number(days):
+    '''
+    Converts int32 day numbers back to datetimes.
+    '''
+    return pd.Series(
+        pd.to_datetime(np.asarray(days, dtype=np.int64), unit='D'),
+        index=days.index, name=days.name
+    )
+
+
+def day_number_year(days):
+    '''
+    Extracts the calendar year of int32 day numbers as int16.
+    '''
+    years = np.asarray(days, dtype='datetime64[D]').astype('datetime64[Y]').astype(np.int64) + 1970
+    return pd.Series(years.astype(np.int16), index=days.index)
+
+
+def build_firm_lookup(*infocodes):
+    '''
+    Builds the lookup table mapping dense int32 `firm_id`s to Datastream `infocode`s.
+    '''
+    codes = pd.concat([pd.Series(c) for c in infocodes], ignore_index=True).dropna()
+    codes = np.unique(codes.astype(np.int64)).astype(np.int32)
+    return pd.DataFrame({
+        'firm_id': np.arange(len(codes), dtype=np.int32),
+        'infocode': codes
+    })
+
+
+def encode_firm_ids(infocodes, lookup):
+    '''
+    Maps `infocode`s to dense `firm_id`s, returning -1 for codes not in the lookup table.
+    '''
+    positions = pd.Index(lookup['infocode']).get_indexer(infocodes)
+    firm_ids = np.where(positions >= 0, lookup['firm_id'].to_numpy()[positions], -1)
+    return pd.Series(firm_ids.astype(np.int32), index=infocodes.index)
+
+
+def compact_datastream(ds2dsf, lookup, cfg):
+    '''
+    Reduces the pulled Datastream panel to the compact schema, keeping only
+    `firm_id`, `infocode`, `marketdate` (day number) and `ret`, plus `region` (categorical)
+    and the configured `market_value_column` when they were loaded.
+    Establishes the (infocode, marketdate) order the downstream steps rely on. This is the one
+    sort of the daily panel: the pulled Parquet file is Hive-partitioned by year/region and
+    reads back year-major, while the later steps only verify the order.
+    '''
+    ds = ds2dsf.dropna(subset=['infocode', 'marketdate'])
+    compact = pd.DataFrame({
+        'firm_id': encode_firm_ids(ds['infocode'].astype(np.int32), lookup),
+        'infocode': ds['infocode'].astype(np.int32),
+        'marketdate': to_day_number(ds['marketdate']),
+        'ret': ds['ret'].astype(return_dtype(cfg)),
+    })
+    if 'region' in ds.columns:
+        compact['region'] = ds['region'].astype('category')
+    mv_col = cfg.get('market_value_column')
+    if mv_col and mv_col in ds.columns:
+        compact[mv_col] = ds[mv_col].astype(np.float64)
+    panel_order = ['infocode', 'marketdate']
+    if not is_sorted(compact, panel_order):
+        log.info("Sorting the Datastream panel by (infocode, marketdate) once at ingest.")
+        compact = compact.sort_values(panel_order, kind='stable')
+    return mark_sorted(compact.reset_index(drop=True), panel_order)
+
+
+def decode_for_output(df):
+    '''
+    Converts day-number columns back to datetimes so written files stay readable.
+    '''
+    df = df.copy()
+    for col in DATE_COLUMNS:
+        if col in df.columns and pd.api.types.is_integer_dtype(df[col]):
+            df[col] = from_day_number(df[col])
+    return df
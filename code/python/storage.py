@@ -0,0 +1,173 @@
+import os
+import shutil
+from urllib.parse import quote
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from utils import setup_logging
+from sampling import sample_fraction
+from ordering import ORDER_ATTR, ensure_sorted, is_sorted, mark_sorted, sorted_by
+
+log = setup_logging()
+
+HIVE_NULL = '__HIVE_DEFAULT_PARTITION__'  # Directory name of the partition for missing values
+
+# Defaults for the `output_writer` section of the config files. Each artifact can
+# override any of these under `output_writer: artifacts: <name>:`.
+WRITER_DEFAULTS = {
+    'formats': ['parquet', 'csv'],  # Any of: parquet, csv
+    'compression': 'zstd',
+    'compression_level': 3,
+    'row_group_size': 262144,  # Rows per Parquet row group
+    'sort_by': None,  # Columns to sort by before writing, so row group statistics are tight
+    'partition_by': None,  # Hive partition columns; `year` is derived from `year_from` if missing
+    'year_from': None,  # Date column used to derive the `year` partition column
+}
+
+
+def writer_options(cfg, artifact):
+    '''
+    Returns the writer options for an artifact: defaults, then `output_writer`, then the artifact override.
+    '''
+    writer_cfg = dict(cfg.get('output_writer') or {})
+    artifact_cfg = (writer_cfg.pop('artifacts', None) or {}).get(artifact) or {}
+    options = {**WRITER_DEFAULTS, **writer_cfg, **artifact_cfg}
+    unknown = set(options['formats']) - {'parquet', 'csv'}
+    if unknown:
+        raise ValueError(f"Unknown output formats for {artifact}: {sorted(unknown)}")
+    return options
+
+
+def write_output(df, cfg, artifact, parquet_path, csv_path=None):
+    '''
+    Writes an artifact in the configured formats: zstd-compressed Parquet with sorted,
+    sized row groups (Hive-partitioned into a directory if `partition_by` is set),
+    and optionally CSV. Parquet files record the quick-look `sample_fraction` and, for
+    single files, the verified row order (`sorted_by`) in their metadata.
+    '''
+    options = writer_options(cfg, artifact)
+    options['metadata'] = {'sample_fraction': str(sample_fraction(cfg))}
+
+    if options['sort_by']:
+        df = ensure_sorted(df, options['sort_by'], artifact)
+    # Partitioned datasets are read back partition by partition, so their order is not recorded
+    order = _order_prefix(sorted_by(df), df.columns)
+    if order and not options['partition_by'] and is_sorted(df, order):
+        options['metadata'][ORDER_ATTR] = ','.join(order)
+
+    if 'parquet' in options['formats']:
+        _write_parquet(df, parquet_path, options)
+        log.info(f"Saved {artifact} to {parquet_path} (Parquet, {options['compression']})")
+
+    if 'csv' in options['formats']:
+        if csv_path is None:
+            raise ValueError(f"CSV output requested for {artifact} but no CSV path is configured")
+        df.to_csv(csv_path, index=False)
+        log.info(f"Saved {artifact} to {csv_path} (CSV)")
+
+
+def _order_prefix(keys, columns):
+    '''
+    The sort keys up to the first one that is not among `columns`.
+    '''
+    order = []
+    for key in keys:
+        if key not in columns:
+            break
+        order.append(key)
+    return order
+
+
+def _write_parquet(df, path, options):
+    partition_by = options['partition_by']
+    if partition_by and 'year' in partition_by and 'year' not in df.columns:
+        df = df.assign(year=pd.to_datetime(df[options['year_from']]).dt.year)
+
+    # Replace the previous output completely, whether it was a file or a partitioned directory
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+    if not partition_by:
+        _write_table(df, path, options)
+        return
+
+    # One file per Hive partition with pq.write_table; pyarrow's dataset writer can abort the
+    # interpreter at exit (pyarrow 15)
+    os.makedirs(path)
+    for values, part in df.groupby(partition_by, sort=True, dropna=False, observed=True):
+        values = values if isinstance(values, tuple) else (values,)
+        directory = os.path.join(path, *(f"{key}={_partition_value(value)}" for key, value in zip(partition_by, values)))
+        os.makedirs(directory, exist_ok=True)
+        _write_table(part.drop(columns=partition_by), os.path.join(directory, 'part-0.parquet'), options)
+
+
+def _partition_value(value):
+    if pd.isna(value):
+        return HIVE_NULL
+    return quote(str(value), safe='')
+
+
+def _write_table(df, path, options):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **options.get('metadata', {})})
+    pq.write_table(
+        table, path,
+        compression=options['compression'],
+        compression_level=options['compression_level'],
+        row_group_size=options['row_group_size'],
+    )
+
+
+CSV_CHUNK_ROWS = 1_000_000
+
+
+def read_output(parquet_path, csv_path=None, columns=None, filters=None):
+    '''
+    Reads an artifact written by `write_output`, preferring Parquet and falling back to CSV.
+    For Parquet, `filters` (e.g. [("year", ">=", 2020)]) are pushed down so only
+    matching partitions and row groups are read, and a recorded row order is restored
+    as the ordering invariant of the returned frame.
+    '''
+    if os.path.exists(parquet_path):
+        table = pq.read_table(parquet_path, columns=columns, filters=filters,
+                              partitioning=ds.partitioning(flavor='hive'))
+        df = table.to_pandas()
+        order = (table.schema.metadata or {}).get(ORDER_ATTR.encode())
+        if order and os.path.isfile(parquet_path):
+            mark_sorted(df, _order_prefix(order.decode().split(','), df.columns))
+        return df
+
+    if csv_path is None or not os.path.exists(csv_path):
+        raise FileNotFoundError(f"Neither {parquet_path} nor {csv_path} exists")
+
+    if not filters:
+        return pd.read_csv(csv_path, usecols=columns)
+
+    # CSV has no statistics to skip data with, so filter chunk by chunk to bound memory
+    log.info(f"Reading {csv_path} in chunks to apply filters")
+    read_columns = None if columns is None else list(dict.fromkeys(list(columns) + [f[0] for f in filters]))
+    chunks = [
+        chunk[_apply_filters(chunk, filters)]
+        for chunk in pd.read_csv(csv_path, usecols=read_columns, chunksize=CSV_CHUNK_ROWS)
+    ]
+    df = pd.concat(chunks, ignore_index=True)
+    return df if columns is None else df[list(columns)]
+
+
+def _apply_filters(df, filters):
+    '''
+    Evaluates conjunctive (column, op, value) filters on a loaded DataFrame.
+    '''
+    ops = {
+        '==': lambda s, v: s == v, '=': lambda s, v: s == v, '!=': lambda s, v: s != v,
+        '<': lambda s, v: s < v, '<=': lambda s, v: s <= v,
+        '>': lambda s, v: s > v, '>=': lambda s, v: s >= v,
+        'in': lambda s, v: s.isin(v), 'not in': lambda s, v: ~s.isin(v),
+    }
+    mask = pd.Series(True, index=df.index)
+    for col, op, value in filters:
+        mask &= ops[op](df[col], value)
+    return mask
@@ -0,0 +1,158 @@
+import hashlib
+import os
+import re
+import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils import setup_logging
+
+log = setup_logging()
+
+# Local query-result cache between the pull scripts and the WRDS connection.
+# Each query is keyed by its normalized SQL plus the version dates of the tables it reads
+# (`wrds_cache: table_versions:` in pull_data_cfg.yaml). Results are stored as Parquet in
+# `cache_dir` and served without connecting while they are valid: until the table's version
+# date changes or, for tables without a version date (and queries whose tables are not
+# detected), until they are `max_age_days` old.
+# With `offline: true` (or WRDS_OFFLINE=1) the cache is the only source, so a recorded
+# cache doubles as a stand-in for WRDS in offline tests and benchmarks.
+
+CACHE_DEFAULTS = {
+    'enabled': True,
+    'cache_dir': 'data/pulled/wrds_cache',
+    'max_size_gb': 20,  # Least recently used results are evicted above this size
+    'max_age_days': 30,  # Validity of results for tables without a version date (empty: no limit)
+    'offline': False,
+    'table_versions': {},
+}
+
+_LITERALS = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+_TABLES = re.compile(r"\b(?:from|join)\s+([a-z_]\w*\.[a-z_]\w*)")
+
+
+def cache_options(cfg):
+    '''
+    Returns the `wrds_cache` options with the defaults filled in.
+    '''
+    options = {**CACHE_DEFAULTS, **(cfg.get('wrds_cache') or {})}
+    options['table_versions'] = {table.lower(): version for table, version in (options['table_versions'] or {}).items()}
+    if os.getenv('WRDS_OFFLINE', '').lower() in ('1', 'true', 'yes'):
+        options['offline'] = True
+    return options
+
+
+def normalize_sql(sql):
+    '''
+    Collapses whitespace and lowercases everything except quoted literals and identifiers,
+    and drops a trailing semicolon, so formatting differences map to the same cache entry.
+    '''
+    parts = _LITERALS.split(sql)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r"\s+", " ", parts[i]).lower()
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def query_tables(sql):
+    '''
+    The `library.table` names a normalized query reads from.
+    '''
+    return sorted(set(_TABLES.findall(_LITERALS.sub("''", sql))))
+
+
+class CachedConnection:
+    '''
+    Drop-in for the `raw_sql`/`get_table`/`close` methods of `wrds.Connection` that serves
+    cached results and only calls `connect` (e.g. asking for credentials) on a cache miss.
+    '''
+
+    def __init__(self, cfg, connect):
+        self.options = cache_options(cfg)
+        self._connect = connect
+        self._db = None
+
+    def raw_sql(self, sql, **kwargs):
+        return self._cached(normalize_sql(sql), kwargs, lambda db: db.raw_sql(sql, **kwargs))
+
+    def get_table(self, library, table, **kwargs):
+        sql = normalize_sql(f"SELECT * FROM {library}.{table}")
+        return self._cached(sql, kwargs, lambda db: db.get_table(library=library, table=table, **kwargs))
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            log.info("Disconnected from WRDS")
+
+    def _connection(self):
+        if self._db is None:
+            self._db = self._connect()
+        return self._db
+
+    def _cached(self, sql, kwargs, run):
+        if not self.options['enabled']:
+            return run(self._connection())
+
+        versions = {table: str(self.options['table_versions'].get(table) or '') for table in query_tables(sql)}
+        path = self._path(sql, kwargs, versions)
+
+        if self._is_valid(path, versions):
+            os.utime(path)  # Marks the entry as recently used for the eviction
+            log.info(f"Serving query from the WRDS cache ({os.path.basename(path)}): {sql}")
+            return pq.read_table(path).to_pandas()
+
+        if self.options['offline']:
+            raise FileNotFoundError(f"Offline mode: no valid cached result for query: {sql}")
+
+        df = run(self._connection())
+        try:
+            self._store(df, path, sql, versions)
+        except (pa.ArrowException, OSError) as e:
+            log.warning(f"Could not cache the result of query {sql}: {e}")
+        return df
+
+    def _path(self, sql, kwargs, versions):
+        key = "\n".join([sql, repr(sorted(kwargs.items())), repr(sorted(versions.items()))])
+        digest = hashlib.sha256(key.encode()).hexdigest()[:32]
+        return os.path.join(self.options['cache_dir'], f"{digest}.parquet")
+
+    def _is_valid(self, path, versions):
+        if not os.path.exists(path):
+            return False
+        max_age_days = self.options['max_age_days']
+        # Queries without a detected table, or reading any table without a version date, are age-limited
+        if (versions and all(versions.values())) or not max_age_days:
+            return True
+        created = float(pq.read_schema(path).metadata.get(b'created', b'0'))
+        return time.time() - created <= max_age_days * 86400
+
+    def _store(self, df, path, sql, versions):
+        os.makedirs(self.options['cache_dir'], exist_ok=True)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}),
+            'sql': sql, 'versions': repr(sorted(versions.items())), 'created': str(time.time()),
+        })
+        # Write to a temporary file first so an interrupted pull never leaves a partial entry
+        tmp_path = f"{path}.tmp"
+        pq.write_table(table, tmp_path, compression='zstd')
+        os.replace(tmp_path, path)
+        log.info(f"Cached query result in {path}")
+        self._evict(keep=path)
+
+    def _evict(self, keep):
+        '''
+        Removes the least recently used results until the cache fits in `max_size_gb`.
+        '''
+        cache_dir = self.options['cache_dir']
+        entries = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.parquet')]
+        entries.sort(key=os.path.getmtime)
+        size = sum(os.path.getsize(p) for p in entries)
+        limit = self.options['max_size_gb'] * 1e9
+        for entry in entries:
+            if size <= limit:
+                break
+            if entry == keep:
+                continue
+            size -= os.path.getsize(entry)
+            os.remove(entry)
+            log.info(f"Evicted {entry} from the WRDS cache")